@@ -1,21 +1,36 @@
 import nltk
 import logging
 import asyncio
-from indexer import Indexer
+from indexer import Indexer, Config
 from pydantic import BaseModel
 from storage import MinimaStore
 from async_queue import AsyncQueue
-from fastapi import FastAPI, APIRouter
+from fastapi import FastAPI, APIRouter, Header
 from contextlib import asynccontextmanager
 from fastapi_utilities import repeat_every
-from async_loop import index_loop, crawl_loop
+from pipeline import IndexPipeline
+from coordinator import ReindexCoordinator
+from embedding_scheduler import EmbeddingScheduler
+from embedding_format import negotiate, vectors_response
+from async_loop import index_loop, enqueue_requested_files, message_priority
+from watcher import watch_loop
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 indexer = Indexer()
+pipeline = IndexPipeline(indexer)
 router = APIRouter()
-async_queue = AsyncQueue()
+async_queue = AsyncQueue(maxsize=Config.INDEX_QUEUE_SIZE, priority=message_priority)
+# file events and explicit index requests, consumed by an index loop that runs for the app's lifetime
+live_queue = AsyncQueue(maxsize=Config.INDEX_QUEUE_SIZE, priority=message_priority)
+coordinator = ReindexCoordinator(async_queue, indexer, pipeline)
+# coalesces concurrent /embedding requests into one forward pass
+embedding_scheduler = EmbeddingScheduler(
+    indexer.embed_batch,
+    max_batch_size=Config.EMBEDDING_MAX_BATCH_SIZE,
+    max_wait_seconds=Config.EMBEDDING_MAX_WAIT_SECONDS
+)
 MinimaStore.create_db_and_tables()
 
 def init_loader_dependencies():
@@ -32,6 +47,15 @@ class Query(BaseModel):
     query: str
 
 
+class EmbeddingRequest(BaseModel):
+    query: str | None = None
+    texts: list[str] | None = None
+
+
+class IndexRequest(BaseModel):
+    paths: list[str]
+
+
 @router.post(
     "/query", 
     response_description='Query local data storage',
@@ -39,7 +63,9 @@ class Query(BaseModel):
 async def query(request: Query):
     logger.info(f"Received query: {query}")
     try:
-        result = indexer.find(request.query)
+        # Encoded on the scheduler's own thread, never on the event loop or the indexing pool.
+        query_vector = (await embedding_scheduler.embed([request.query]))[0]
+        result = await indexer.find(request.query, query_vector)
         logger.info(f"Found {len(result)} results for query: {query}")
         logger.info(f"Results: {result}")
         return {"result": result}
@@ -50,25 +76,86 @@ async def query(request: Query):
 
 @router.post(
     "/embedding", 
-    response_description='Get embedding for a query',
+    response_description='Get embedding for a query, or for each of a list of texts',
 )
-async def embedding(request: Query):
-    logger.info(f"Received embedding request: {request}")
+async def embedding(request: EmbeddingRequest, accept: str | None = Header(default=None)):
+    texts = request.texts if request.texts is not None else [request.query or ""]
+    logger.info(f"Received embedding request: {len(texts)} texts, {sum(len(text) for text in texts)} characters")
+    media_type = negotiate(accept)
     try:
-        result = indexer.embed(request.query)
-        logger.info(f"Found {len(result)} results for query: {request.query}")
+        if request.texts is not None:
+            result = await embedding_scheduler.embed(request.texts)
+            logger.info(f"Embedded {len(result)} texts")
+            if media_type is not None:
+                return vectors_response(result, media_type)
+            return {"result": result}
+        if request.query is None:
+            return {"error": "Either query or texts is required"}
+        result = (await embedding_scheduler.embed([request.query]))[0]
+        logger.info(f"Embedded query of {len(request.query)} characters")
+        if media_type is not None:
+            return vectors_response([result], media_type)
         return {"result": result}
     except Exception as e:
         logger.error(f"Error in processing embedding: {e}")
         return {"error": str(e)}    
 
 
+@router.post(
+    "/index",
+    response_description='Index files ahead of the background crawl',
+)
+async def index(request: IndexRequest):
+    logger.info(f"Received index request: {request}")
+    try:
+        accepted = await enqueue_requested_files(live_queue, request.paths)
+        return {"result": accepted}
+    except Exception as e:
+        logger.error(f"Error in processing index request: {e}")
+        return {"error": str(e)}
+
+
+@router.post(
+    "/reindex",
+    response_description='Start a full crawl, or queue one after the running crawl',
+)
+async def reindex():
+    return {"result": coordinator.trigger("request")}
+
+
+@router.get(
+    "/reindex",
+    response_description='State of the current reindexing run',
+)
+async def reindex_status():
+    return {"result": coordinator.status()}
+
+
+@router.get(
+    "/stats",
+    response_description='Indexing pipeline throughput per stage',
+)
+async def stats():
+    return {
+        "pipeline": pipeline.get_stats(),
+        "embedding_cache": indexer.embedding_cache.get_stats(),
+        "query_cache": indexer.query_cache.get_stats(),
+        "embedding_scheduler": embedding_scheduler.get_stats(),
+    }
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    pipeline.start()
+    embedding_scheduler.start()
     tasks = [
-        asyncio.create_task(crawl_loop(async_queue)),
-        asyncio.create_task(index_loop(async_queue, indexer))
+        asyncio.create_task(index_loop(live_queue, indexer, pipeline, live=True))
     ]
+    if Config.WATCH_MODE:
+        logger.info("Watch mode enabled, full crawl is used for reconciliation only")
+        tasks.append(asyncio.create_task(
+            watch_loop(live_queue, on_restart=lambda: coordinator.trigger("watcher restart"))
+        ))
     await schedule_reindexing()
     try:
         yield
@@ -76,6 +163,10 @@ async def lifespan(app: FastAPI):
         for task in tasks:
             task.cancel()
         await asyncio.gather(*tasks, return_exceptions=True)
+        await coordinator.stop()
+        await pipeline.stop()
+        await embedding_scheduler.stop()
+        await indexer.async_qdrant.close()
 
 
 def create_app() -> FastAPI:
@@ -87,20 +178,10 @@ def create_app() -> FastAPI:
     app.include_router(router)
     return app
 
-async def trigger_re_indexer():
-    logger.info("Reindexing triggered")
-    try:
-        await asyncio.gather(
-            crawl_loop(async_queue),
-            index_loop(async_queue, indexer)
-        )
-        logger.info("reindexing finished")
-    except Exception as e:
-        logger.error(f"error in scheduled reindexing {e}")
-
-
-@repeat_every(seconds=60*20)
+@repeat_every(
+    seconds=Config.RECONCILE_INTERVAL_SECONDS if Config.WATCH_MODE else Config.CRAWL_INTERVAL_SECONDS
+)
 async def schedule_reindexing():
-    await trigger_re_indexer()
+    coordinator.trigger("schedule")
 
 app = create_app()
\ No newline at end of file
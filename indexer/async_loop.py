@@ -1,63 +1,195 @@
 import os
+import math
+import time
 import uuid
 import asyncio
 import logging
 from indexer import Indexer
+from pipeline import IndexPipeline
+from snapshot import CrawlSnapshot, FileStat
+from crawler import walk_files, is_supported, in_excluded_dir
+from ignore import IgnoreMatcher
+from storage import MinimaStore, SQLITE_BATCH_SIZE
 from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
-executor = ThreadPoolExecutor()
 
 CONTAINER_PATH = os.environ.get("CONTAINER_PATH")
-AVAILABLE_EXTENSIONS = [".pdf", ".xls", "xlsx", ".doc", ".docx", ".txt", ".md", ".csv", ".ppt", ".pptx"]
+LOCAL_FILES_PATH = os.environ.get("LOCAL_FILES_PATH")
+INDEX_CONCURRENCY = int(os.environ.get("INDEX_CONCURRENCY", 4))
+CHANGE_BATCH_SIZE = int(os.environ.get("CHANGE_BATCH_SIZE", 500))
 
+PRIORITY_REQUESTED = 0
+PRIORITY_FILE = 1
+PRIORITY_CONTROL = 2
 
-async def crawl_loop(async_queue):
+executor = ThreadPoolExecutor(max_workers=INDEX_CONCURRENCY)
+# Watcher events and requests hash and look up their files apart from the backfill's batches.
+live_executor = ThreadPoolExecutor(max_workers=INDEX_CONCURRENCY, thread_name_prefix="live")
+
+
+def file_message(path: str, mtime_ns: int, size: int, requested: bool = False) -> dict:
+    return {
+        "path": path,
+        "file_id": str(uuid.uuid4()),
+        "last_updated_seconds": round(mtime_ns / 1e9),
+        "size": size,
+        "requested": requested,
+        "type": "file"
+    }
+
+
+def message_priority(message: dict) -> tuple:
+    # Explicit requests first, then files by age bucket (minutes, hours, days, ...) and size,
+    # control messages last so purges and the end of a crawl still follow their files.
+    if message["type"] != "file":
+        return (PRIORITY_CONTROL, 0, 0)
+    if message["requested"]:
+        return (PRIORITY_REQUESTED, 0, message["size"])
+    age_seconds = max(time.time() - message["last_updated_seconds"], 1)
+    return (PRIORITY_FILE, int(math.log2(age_seconds)), message["size"])
+
+
+async def enqueue_requested_files(async_queue, paths: list[str]) -> list[str]:
+    root = os.path.abspath(CONTAINER_PATH)
+    matcher = IgnoreMatcher(root)
+    accepted: list[str] = []
+    for path in paths:
+        if LOCAL_FILES_PATH and path.startswith(LOCAL_FILES_PATH):
+            path = path.replace(LOCAL_FILES_PATH, CONTAINER_PATH, 1)
+        path = os.path.abspath(os.path.join(root, path))
+        if os.path.commonpath([root, path]) != root:
+            logger.warning(f"Requested file {path} is outside of {root}, skipping")
+            continue
+        if not is_supported(path):
+            logger.warning(f"Requested file {path} is not supported, skipping")
+            continue
+        if (matcher.ignored(path, is_dir=False) or matcher.too_deep(os.path.dirname(path))
+                or in_excluded_dir(os.path.dirname(path), root)):
+            logger.warning(f"Requested file {path} is excluded by ignore rules, skipping")
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            logger.warning(f"Requested file {path} can't be read: {e}")
+            continue
+        if matcher.too_large(stat.st_size):
+            logger.warning(f"Requested file {path} exceeds the maximum file size, skipping")
+            continue
+        await async_queue.enqueue(file_message(path, mtime_ns=stat.st_mtime_ns, size=stat.st_size, requested=True))
+        accepted.append(path)
+        logger.info(f"Requested file enqueue: {path}")
+    return accepted
+
+
+async def crawl_loop(async_queue, reconcile: bool = False) -> dict:
     logger.info(f"Starting crawl loop with path: {CONTAINER_PATH}")
-    existing_file_paths: list[str] = []
-    for root, _, files in os.walk(CONTAINER_PATH):
-        logger.info(f"Processing folder: {root}")
-        for file in files:
-            if not any(file.endswith(ext) for ext in AVAILABLE_EXTENSIONS):
-                logger.info(f"Skipping file: {file}")
-                continue
-            path = os.path.join(root, file)
-            message = {
-                "path": path,
-                "file_id": str(uuid.uuid4()),
-                "last_updated_seconds": round(os.path.getmtime(path)),
-                "type": "file"
-            }
-            existing_file_paths.append(path)
-            async_queue.enqueue(message)
-            logger.info(f"File enqueue: {path}")
-        aggregate_message = {
-            "existing_file_paths": existing_file_paths,
-            "type": "all_files"
-        }
-        async_queue.enqueue(aggregate_message)
-        async_queue.enqueue({"type": "stop"})
-
-
-async def index_loop(async_queue, indexer: Indexer):
     loop = asyncio.get_running_loop()
-    logger.info("Starting index loop")
+    snapshot = await loop.run_in_executor(executor, CrawlSnapshot.load)
+    # The snapshot only knows files earlier crawls saw. A reconcile crawl diffs against the store,
+    # which also holds files the watcher or requests indexed and whose deletion was missed.
+    purge = reconcile or not snapshot.loaded
+    crawl_id = uuid.uuid4().hex
+    crawled_paths: list[str] = []
+    current: dict[str, FileStat] = {}
+    changed = 0
+    # Ignore files are compiled once per crawl, edits to them apply from the next crawl on.
+    matcher = IgnoreMatcher(CONTAINER_PATH)
+    async for files in walk_files(CONTAINER_PATH, matcher):
+        for path, stat in files:
+            current[path] = stat
+            if snapshot.change(path, stat) is not None:
+                # Waits while the index queue is full, so the walk pauses until indexing catches up.
+                await async_queue.enqueue(file_message(path, mtime_ns=stat[0], size=stat[1]))
+                changed += 1
+                logger.info(f"File enqueue: {path}")
+            if purge:
+                crawled_paths.append(path)
+                if len(crawled_paths) >= SQLITE_BATCH_SIZE:
+                    await loop.run_in_executor(executor, MinimaStore.add_crawled_paths, crawl_id, crawled_paths)
+                    crawled_paths = []
+
+    deleted = snapshot.deleted(current)
+    logger.info(f"Crawl found {len(current)} files: {changed} new or modified, {len(deleted)} deleted")
+    if purge:
+        await loop.run_in_executor(executor, MinimaStore.add_crawled_paths, crawl_id, crawled_paths)
+        await async_queue.enqueue({"crawl_id": crawl_id, "type": "all_files"})
+    elif deleted:
+        await async_queue.enqueue({"removed_file_paths": deleted, "type": "removed_files"})
+    await async_queue.enqueue({"snapshot": CrawlSnapshot(current), "type": "stop"})
+    return {"files": len(current), "changed": changed, "deleted": len(deleted)}
+
+
+async def index_loop(async_queue, indexer: Indexer, pipeline: IndexPipeline, live: bool = False):
+    # The live loop (watcher events, requests) uses its own pipeline slots, so a backfill never holds it up.
+    loop = asyncio.get_running_loop()
+    index_executor = live_executor if live else executor
+    logger.info(f"Starting index loop with concurrency {INDEX_CONCURRENCY}")
+    slots = asyncio.Semaphore(INDEX_CONCURRENCY)
+    in_flight: set[asyncio.Task] = set()
+
+    async def index_files(messages, paths):
+        try:
+            docs, failed_paths = await loop.run_in_executor(
+                index_executor, indexer.prepare_batch, messages, pipeline.is_busy
+            )
+            # Files that could not be checked stay out of the snapshot, so the next crawl retries them.
+            pipeline.failed_paths.update(failed_paths)
+            priorities = {message["path"]: message_priority(message) for message in messages}
+            for path, last_updated_seconds, content_hash in docs:
+                await pipeline.submit(path, last_updated_seconds, content_hash, priorities[path], live)
+        except Exception as e:
+            logger.error(f"Error in processing messages: {e}")
+            logger.error(f"Failed to process {len(messages)} files: {paths}")
+            pipeline.failed_paths.update(paths)
+        finally:
+            pipeline.release(paths)
+            slots.release()
+
     while True:
-        if async_queue.size() == 0:
-            logger.info("No files to index. Indexing stopped, all files indexed.")
-            await asyncio.sleep(1)
+        messages = await async_queue.dequeue_batch(CHANGE_BATCH_SIZE, lambda message: message["type"] == "file")
+        message = messages[0]
+        if message["type"] == "file":
+            logger.info(f"Processing {len(messages)} file messages")
+            await slots.acquire()
+            paths = [message["path"] for message in messages]
+            # Other batches must not copy vectors from these files, and removals must wait, while they may change.
+            pipeline.reserve(paths)
+            task = asyncio.create_task(index_files(messages, paths))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
             continue
-        message = await async_queue.dequeue()
         logger.info(f"Processing message: {message}")
         try:
-            if message["type"] == "file":
-                await loop.run_in_executor(executor, indexer.index, message)
-            elif message["type"] == "all_files":
-                await loop.run_in_executor(executor, indexer.purge, message)
+            if message["type"] == "removed_files":
+                removed_file_paths = list(message["removed_file_paths"])
+                removed_dir_paths = message.get("removed_dir_paths", [])
+                if removed_dir_paths:
+                    # Files below a removed folder are known from the store and from the work in flight.
+                    removed_file_paths += await loop.run_in_executor(
+                        index_executor, MinimaStore.find_paths_under, removed_dir_paths
+                    )
+                    removed_file_paths += pipeline.busy_under(removed_dir_paths)
+                    removed_file_paths = list(dict.fromkeys(removed_file_paths))
+                # Only work on the removed paths is waited for, the rest of the pipeline keeps running.
+                await pipeline.wait_for(removed_file_paths)
+                await loop.run_in_executor(
+                    index_executor, indexer.remove, {**message, "removed_file_paths": removed_file_paths}
+                )
+                continue
+            # Purges and the end of a crawl must observe every file enqueued before them.
+            if in_flight:
+                await asyncio.gather(*in_flight)
+            await pipeline.join()
+            if message["type"] == "all_files":
+                await loop.run_in_executor(index_executor, indexer.purge, message)
             elif message["type"] == "stop":
+                # Failed files stay out of the snapshot, so the next crawl picks them up again.
+                snapshot = message["snapshot"]
+                for path in pipeline.take_failed_paths():
+                    snapshot.entries.pop(path, None)
+                await loop.run_in_executor(index_executor, snapshot.save)
                 break
         except Exception as e:
             logger.error(f"Error in processing message: {e}")
             logger.error(f"Failed to process message: {message}")
-        await asyncio.sleep(1)
-
@@ -1,6 +1,6 @@
+import heapq
 import asyncio
-
-from collections import deque
+import itertools
 
 class AsyncQueueDequeueInterrupted(Exception):
   
@@ -10,32 +10,56 @@ class AsyncQueueDequeueInterrupted(Exception):
 
 class AsyncQueue:
 
-    def __init__(self):
-        self._data = deque([])
+    def __init__(self, maxsize=0, priority=None):
+        # Values are dequeued lowest `priority(value)` first, FIFO among equal priorities.
+        self._data = []
+        self._counter = itertools.count()
+        self._priority = priority
+        self._maxsize = maxsize
         self._presense_of_data = asyncio.Event()
+        self._presense_of_space = asyncio.Event()
+        self._presense_of_space.set()
+        self._shutdown = False
 
-    def enqueue(self, value):
-        self._data.append(value)
-
-        if len(self._data) == 1:
-            self._presense_of_data.set()
+    async def enqueue(self, value):
+        while self._maxsize and len(self._data) >= self._maxsize:
+            self._presense_of_space.clear()
+            await self._presense_of_space.wait()
+        priority = self._priority(value) if self._priority else 0
+        heapq.heappush(self._data, (priority, next(self._counter), value))
+        self._presense_of_data.set()
 
     async def dequeue(self):
-        await self._presense_of_data.wait()
-
-        if len(self._data) < 1:
-            raise AsyncQueueDequeueInterrupted("AsyncQueue was dequeue was interrupted")
+        while not self._data:
+            if self._shutdown:
+                raise AsyncQueueDequeueInterrupted("AsyncQueue was dequeue was interrupted")
+            self._presense_of_data.clear()
+            await self._presense_of_data.wait()
 
-        result = self._data.popleft()
+        result = heapq.heappop(self._data)[2]
+        self._presense_of_space.set()
 
         if not self._data:
             self._presense_of_data.clear()
 
         return result
 
+    async def dequeue_batch(self, limit, accept):
+        # Returns the next value plus the following ones accepted by `accept`, up to
+        # `limit`, without waiting for more and without reordering across rejected values.
+        batch = [await self.dequeue()]
+        if accept(batch[0]):
+            while self._data and len(batch) < limit and accept(self._data[0][2]):
+                batch.append(heapq.heappop(self._data)[2])
+        self._presense_of_space.set()
+        if not self._data:
+            self._presense_of_data.clear()
+        return batch
+
     def size(self):
         result = len(self._data)
         return result
 
     def shutdown(self):
+        self._shutdown = True
         self._presense_of_data.set()
\ No newline at end of file
@@ -0,0 +1,89 @@
+import time
+import asyncio
+import logging
+from indexer import Indexer
+from pipeline import IndexPipeline
+from async_loop import crawl_loop, index_loop
+
+logger = logging.getLogger(__name__)
+
+
+class ReindexCoordinator:
+
+    def __init__(self, async_queue, indexer: Indexer, pipeline: IndexPipeline):
+        self.async_queue = async_queue
+        self.indexer = indexer
+        self.pipeline = pipeline
+        self.runs = 0
+        self.merged_triggers = 0
+        self.trigger_reason: str | None = None
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.last_crawl: dict | None = None
+        self.last_error: str | None = None
+        self._pending = False
+        self._task: asyncio.Task | None = None
+
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def trigger(self, reason: str) -> dict:
+        if self.is_running():
+            # One follow-up run covers every trigger that arrives while a crawl is active.
+            self._pending = True
+            self.merged_triggers += 1
+            logger.info(f"Reindexing already running, merged {reason} trigger")
+        else:
+            self.trigger_reason = reason
+            self._task = asyncio.create_task(self._run_until_idle())
+        return self.status()
+
+    async def _run_until_idle(self) -> None:
+        while True:
+            self._pending = False
+            await self._run_once()
+            if not self._pending:
+                return
+            self.trigger_reason = "merged"
+
+    async def _run_once(self) -> None:
+        self.runs += 1
+        self.started_at = time.time()
+        self.finished_at = None
+        logger.info(f"Reindexing run {self.runs} triggered by {self.trigger_reason}")
+        index_task = asyncio.create_task(index_loop(self.async_queue, self.indexer, self.pipeline))
+        try:
+            try:
+                # With the watcher indexing in between, every crawl is a reconcile against the store.
+                self.last_crawl = await crawl_loop(self.async_queue, reconcile=self.indexer.config.WATCH_MODE)
+            except Exception:
+                # Without the crawl's stop message the index loop would wait forever.
+                index_task.cancel()
+                raise
+            await index_task
+            self.last_error = None
+            logger.info(f"Reindexing run {self.runs} finished: {self.last_crawl}")
+        except Exception as e:
+            self.last_error = str(e)
+            logger.error(f"error in reindexing run {self.runs}: {e}")
+        finally:
+            self.finished_at = time.time()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def status(self) -> dict:
+        return {
+            "state": "running" if self.is_running() else "idle",
+            "run": self.runs,
+            "trigger": self.trigger_reason,
+            "pending": self._pending,
+            "merged_triggers": self.merged_triggers,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "queued": self.async_queue.size(),
+            "last_crawl": self.last_crawl,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,72 @@
+import os
+import asyncio
+import logging
+from typing import AsyncIterator
+from concurrent.futures import ThreadPoolExecutor
+
+from loaders import EXTENSIONS_TO_LOADERS
+from snapshot import FileStat
+from ignore import IgnoreMatcher
+
+logger = logging.getLogger(__name__)
+
+CRAWL_WORKERS = int(os.environ.get("CRAWL_WORKERS", 16))
+CRAWL_EXCLUDE_DIRS = frozenset(name for name in os.environ.get("CRAWL_EXCLUDE_DIRS", "").split(",") if name)
+SUPPORTED_EXTENSIONS = frozenset(EXTENSIONS_TO_LOADERS)
+
+crawl_executor = ThreadPoolExecutor(max_workers=CRAWL_WORKERS, thread_name_prefix="crawl")
+
+
+def is_supported(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in SUPPORTED_EXTENSIONS
+
+
+def in_excluded_dir(dir_path: str, root: str) -> bool:
+    # The walk prunes excluded folders at any depth, a single path has to check every level below root.
+    return any(part in CRAWL_EXCLUDE_DIRS for part in os.path.relpath(dir_path, root).split(os.sep))
+
+
+def _scan_directory(path: str, matcher: IgnoreMatcher) -> tuple[list[tuple[str, FileStat]], list[str]]:
+    files: list[tuple[str, FileStat]] = []
+    subdirs: list[str] = []
+    rules = matcher.rules_for_dir(path)
+    skip_subdirs = matcher.at_max_depth(path)
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if skip_subdirs or entry.name in CRAWL_EXCLUDE_DIRS or rules.ignored(entry.path, is_dir=True):
+                            logger.debug(f"Skipping folder: {entry.path}")
+                            continue
+                        subdirs.append(entry.path)
+                    elif is_supported(entry.name) and not rules.ignored(entry.path, is_dir=False) and entry.is_file():
+                        stat = entry.stat()
+                        if matcher.too_large(stat.st_size):
+                            logger.debug(f"Skipping file over size limit: {entry.path}")
+                            continue
+                        files.append((entry.path, (stat.st_mtime_ns, stat.st_size, stat.st_ino)))
+                except OSError as e:
+                    logger.error(f"Failed to stat {entry.path}: {e}")
+    except OSError as e:
+        logger.error(f"Failed to scan folder {path}: {e}")
+    return files, subdirs
+
+
+# Scans directories on a thread pool, up to 2 * CRAWL_WORKERS at a time, and yields the
+# supported files of each directory as soon as it is scanned. Ignored folders are pruned
+# before they are listed, so nothing below them is ever read or stat'ed.
+async def walk_files(root: str, matcher: IgnoreMatcher | None = None) -> AsyncIterator[list[tuple[str, FileStat]]]:
+    loop = asyncio.get_running_loop()
+    matcher = matcher or IgnoreMatcher(root)
+    pending_dirs = [root]
+    running: set[asyncio.Future] = set()
+    while pending_dirs or running:
+        while pending_dirs and len(running) < CRAWL_WORKERS * 2:
+            running.add(loop.run_in_executor(crawl_executor, _scan_directory, pending_dirs.pop(), matcher))
+        done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            files, subdirs = future.result()
+            pending_dirs.extend(subdirs)
+            if files:
+                yield files
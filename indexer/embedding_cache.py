@@ -0,0 +1,204 @@
+import time
+import sqlite3
+import logging
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+from hashing import text_hash
+from storage import SQLITE_BATCH_SIZE, _batched
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    # Chunks that differ only in unicode form or whitespace get the same vector from the model.
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class EmbeddingCache:
+
+    def __init__(self, file_name: str, max_entries: int):
+        self.file_name = file_name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(file_name, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embedding ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS ix_embedding_last_used ON embedding (last_used)")
+        self.entries = self._connection.execute("SELECT COUNT(*) FROM embedding").fetchone()[0]
+        logger.info(f"Opened embedding cache {file_name} with {self.entries} entries")
+
+    @staticmethod
+    def key(model_id: str, kind: str, text: str) -> str:
+        return text_hash(f"{model_id}\x00{kind}\x00{normalize_text(text)}")
+
+    def get_many(self, keys: List[str]) -> dict[str, List[float]]:
+        found: dict[str, List[float]] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for batch in _batched(unique_keys, SQLITE_BATCH_SIZE):
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embedding WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = array("f", vector).tolist()
+            if found:
+                now = time.time()
+                for batch in _batched(list(found), SQLITE_BATCH_SIZE):
+                    placeholders = ",".join("?" * len(batch))
+                    self._connection.execute(
+                        f"UPDATE embedding SET last_used = ? WHERE key IN ({placeholders})", [now, *batch]
+                    )
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items: dict[str, List[float]]) -> None:
+        if not items:
+            return
+        now = time.time()
+        rows = [(key, array("f", vector).tobytes(), now) for key, vector in items.items()]
+        with self._lock:
+            changes = self._connection.total_changes
+            self._connection.execute("BEGIN")
+            try:
+                # Two batches that missed on the same text both insert it, the second is a no-op
+                # and is not counted as a new entry.
+                self._connection.executemany(
+                    "INSERT INTO embedding (key, vector, last_used) VALUES (?, ?, ?) ON CONFLICT(key) DO NOTHING",
+                    rows
+                )
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+            self.entries += self._connection.total_changes - changes
+            self._evict()
+
+    def _evict(self) -> None:
+        excess = self.entries - self.max_entries
+        if excess <= 0:
+            return
+        self._connection.execute(
+            "DELETE FROM embedding WHERE key IN (SELECT key FROM embedding ORDER BY last_used LIMIT ?)",
+            (excess,)
+        )
+        self.entries -= excess
+        self.evictions += excess
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": self.entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+class QueryEmbeddingCache:
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[List[float], float]] = OrderedDict()
+
+    def get_many(self, keys: List[str]) -> dict[str, List[float]]:
+        found: dict[str, List[float]] = {}
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and self.ttl_seconds > 0 and entry[1] <= now:
+                    del self._entries[key]
+                    self.expired += 1
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = entry[0]
+                self.hits += 1
+        return found
+
+    def put_many(self, items: dict[str, List[float]]) -> None:
+        expires_at = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            for key, vector in items.items():
+                self._entries[key] = (vector, expires_at)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "expired": self.expired,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        cache: EmbeddingCache,
+        model_id: str,
+        query_cache: QueryEmbeddingCache | None = None
+    ):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_id = model_id
+        self.query_cache = query_cache
+
+    def _embed(self, cache, kind: str, texts: List[str], encode) -> List[List[float]]:
+        keys = [EmbeddingCache.key(self.model_id, kind, text) for text in texts]
+        vectors = cache.get_many(keys) if cache is not None else {}
+        missing: dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            encoded = dict(zip(missing, encode(list(missing.values()))))
+            if cache is not None:
+                cache.put_many(encoded)
+            vectors.update(encoded)
+        return [vectors[key] for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(self.cache, "document", texts, self.embeddings.embed_documents)
+
+    # Queries only use the in-memory cache, so they never wait on the SQLite lock the
+    # indexing embed stage holds, nor evict chunk embeddings from it.
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(self.query_cache, "query", [text], lambda texts: [self.embeddings.embed_query(texts[0])])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        # The backends are built without a query prompt, so queries encode exactly like
+        # documents and a batch of them can share one forward pass.
+        return self._embed(self.query_cache, "query", texts, self.embeddings.embed_documents)
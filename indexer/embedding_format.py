@@ -0,0 +1,39 @@
+from typing import List
+
+import msgpack
+import numpy as np
+from fastapi import Response
+
+FLOAT32_MEDIA_TYPE = "application/x-float32"
+FLOAT16_MEDIA_TYPE = "application/x-float16"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+DTYPES = {
+    FLOAT32_MEDIA_TYPE: np.dtype("<f4"),
+    FLOAT16_MEDIA_TYPE: np.dtype("<f2"),
+}
+
+
+def negotiate(accept: str | None) -> str | None:
+    # JSON stays the default, binary formats only on an explicit Accept header.
+    for media_type in (accept or "").split(","):
+        media_type = media_type.split(";")[0].strip().lower()
+        if media_type in DTYPES or media_type == MSGPACK_MEDIA_TYPE:
+            return media_type
+    return None
+
+
+def vectors_response(vectors: List[List[float]], media_type: str) -> Response:
+    # Raw little-endian rows, the shape travels in headers (binary) or alongside the bytes (msgpack).
+    dtype = DTYPES.get(media_type, DTYPES[FLOAT32_MEDIA_TYPE])
+    array = np.asarray(vectors, dtype=dtype)
+    count, dim = array.shape if array.ndim == 2 else (0, 0)
+    if media_type == MSGPACK_MEDIA_TYPE:
+        content = msgpack.packb({"result": array.tobytes(), "shape": [count, dim], "dtype": dtype.str})
+    else:
+        content = array.tobytes()
+    return Response(
+        content=content,
+        media_type=media_type,
+        headers={"X-Embedding-Count": str(count), "X-Embedding-Dim": str(dim)}
+    )
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+from typing import Callable, List
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingScheduler:
+
+    def __init__(self, embed: Callable[[List[str]], List[List[float]]], max_batch_size: int, max_wait_seconds: float):
+        self.embed_fn = embed
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.requests: asyncio.Queue | None = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+        self.batches = 0
+        self.texts = 0
+        self.busy_seconds = 0.0
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self.requests = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        future = asyncio.get_running_loop().create_future()
+        await self.requests.put((texts, future))
+        return await future
+
+    async def _collect(self) -> list:
+        batch = [await self.requests.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait_seconds
+        # Requests that arrive within the wait window share one forward pass.
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self.requests.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            batch = [(texts, future) for texts, future in batch if not future.cancelled()]
+            texts = [text for request_texts, _ in batch for text in request_texts]
+            if not texts:
+                continue
+            start = time.perf_counter()
+            try:
+                vectors = await loop.run_in_executor(self.executor, self.embed_fn, texts)
+            except Exception as e:
+                logger.error(f"Error embedding batch of {len(texts)} texts: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.texts += len(texts)
+            self.busy_seconds += time.perf_counter() - start
+            offset = 0
+            for request_texts, future in batch:
+                if not future.done():
+                    future.set_result(vectors[offset:offset + len(request_texts)])
+                offset += len(request_texts)
+
+    def get_stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "mean_batch_size": round(self.texts / self.batches, 2) if self.batches else 0.0,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "queued": self.requests.qsize() if self.requests is not None else 0,
+        }
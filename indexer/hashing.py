@@ -0,0 +1,15 @@
+import xxhash
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+def file_content_hash(path: str) -> str:
+    digest = xxhash.xxh3_128()
+    with open(path, "rb") as f:
+        while block := f.read(READ_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_hash(text: str) -> str:
+    return xxhash.xxh3_128_hexdigest(text.encode("utf-8"))
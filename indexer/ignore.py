@@ -0,0 +1,93 @@
+import os
+import logging
+from dataclasses import dataclass
+
+import pathspec
+
+logger = logging.getLogger(__name__)
+
+IGNORE_FILE_NAME = ".minimaignore"
+GLOBAL_IGNORE_FILE = os.environ.get("GLOBAL_IGNORE_FILE", "/indexer/storage/.minimaignore")
+IGNORE_PATTERNS = [pattern for pattern in os.environ.get("IGNORE_PATTERNS", "").split(",") if pattern]
+MAX_FILE_SIZE_BYTES = int(float(os.environ.get("MAX_FILE_SIZE_MB", 0)) * 1024 * 1024)
+MAX_DEPTH = int(os.environ.get("MAX_DEPTH", 0))
+
+
+def _read_patterns(file_name: str) -> list[str] | None:
+    try:
+        with open(file_name, encoding="utf-8") as f:
+            return f.read().splitlines()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.error(f"Failed to read ignore file {file_name}: {e}")
+        return None
+
+
+@dataclass
+class IgnoreRules:
+    base_dir: str
+    spec: pathspec.PathSpec | None
+    parent: "IgnoreRules | None" = None
+
+    def ignored(self, path: str, is_dir: bool) -> bool:
+        # Like git, the deepest ignore file with a matching pattern decides, so a
+        # subdirectory can re-include (!pattern) what a parent excluded.
+        rules = self
+        while rules is not None:
+            if rules.spec is not None:
+                relative_path = os.path.relpath(path, rules.base_dir)
+                if is_dir:
+                    relative_path += "/"
+                include = rules.spec.check_file(relative_path).include
+                if include is not None:
+                    return include
+            rules = rules.parent
+        return False
+
+
+class IgnoreMatcher:
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        patterns = (_read_patterns(GLOBAL_IGNORE_FILE) or []) + IGNORE_PATTERNS
+        spec = pathspec.GitIgnoreSpec.from_lines(patterns) if patterns else None
+        self._global_rules = IgnoreRules(base_dir=self.root, spec=spec)
+        self._rules: dict[str, IgnoreRules] = {}
+
+    def rules_for_dir(self, path: str) -> IgnoreRules:
+        # Each directory's ignore file is read and compiled once per matcher.
+        path = os.path.abspath(path)
+        rules = self._rules.get(path)
+        if rules is not None:
+            return rules
+        if path == self.root or os.path.commonpath([self.root, path]) != self.root:
+            parent = self._global_rules
+        else:
+            parent = self.rules_for_dir(os.path.dirname(path))
+        patterns = _read_patterns(os.path.join(path, IGNORE_FILE_NAME))
+        if patterns:
+            rules = IgnoreRules(base_dir=path, spec=pathspec.GitIgnoreSpec.from_lines(patterns), parent=parent)
+        else:
+            rules = parent
+        self._rules[path] = rules
+        return rules
+
+    def ignored(self, path: str, is_dir: bool) -> bool:
+        return self.rules_for_dir(os.path.dirname(os.path.abspath(path))).ignored(path, is_dir)
+
+    def depth(self, path: str) -> int:
+        relative_path = os.path.relpath(os.path.abspath(path), self.root)
+        return 0 if relative_path == os.curdir else len(relative_path.split(os.sep))
+
+    def too_deep(self, dir_path: str) -> bool:
+        return MAX_DEPTH > 0 and self.depth(dir_path) > MAX_DEPTH
+
+    def at_max_depth(self, dir_path: str) -> bool:
+        return MAX_DEPTH > 0 and self.depth(dir_path) >= MAX_DEPTH
+
+    def too_large(self, size: int) -> bool:
+        return MAX_FILE_SIZE_BYTES > 0 and size > MAX_FILE_SIZE_BYTES
+
+    def invalidate(self) -> None:
+        self._rules.clear()
@@ -4,43 +4,34 @@ import torch
 import logging
 import time
 from dataclasses import dataclass
-from typing import List, Dict
-from pathlib import Path
+from typing import Callable, List, Dict, Tuple
 
-from qdrant_client import QdrantClient
+from qdrant_client import QdrantClient, AsyncQdrantClient
 from langchain_qdrant import QdrantVectorStore
 from langchain_huggingface import HuggingFaceEmbeddings
-from qdrant_client.http.models import Distance, VectorParams, Filter, FieldCondition, MatchValue
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-
-from langchain_community.document_loaders import (
-    TextLoader,
-    CSVLoader,
-    Docx2txtLoader,
-    UnstructuredExcelLoader,
-    PyMuPDFLoader,
-    UnstructuredPowerPointLoader,
-)
+from qdrant_client.http.models import Distance, VectorParams, Filter, FieldCondition, MatchValue, MatchAny, PointStruct, PointIdsList
 
+from loaders import EXTENSIONS_TO_LOADERS, Chunk
+from hashing import file_content_hash, text_hash
+from embedding_cache import EmbeddingCache, CachedEmbeddings, QueryEmbeddingCache
+from onnx_embeddings import load_onnx_embeddings
 from storage import MinimaStore, IndexingStatus
 
 logger = logging.getLogger(__name__)
 
+POINT_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "minima/indexer/points")
+
+
+@dataclass
+class PendingChunk:
+    chunk_id: str
+    text: str
+    metadata: dict
+
 
 @dataclass
 class Config:
-    EXTENSIONS_TO_LOADERS = {
-        ".pdf": PyMuPDFLoader,
-        ".pptx": UnstructuredPowerPointLoader,
-        ".ppt": UnstructuredPowerPointLoader,
-        ".xls": UnstructuredExcelLoader,
-        ".xlsx": UnstructuredExcelLoader,
-        ".docx": Docx2txtLoader,
-        ".doc": Docx2txtLoader,
-        ".txt": TextLoader,
-        ".md": TextLoader,
-        ".csv": CSVLoader,
-    }
+    EXTENSIONS_TO_LOADERS = EXTENSIONS_TO_LOADERS
     
     DEVICE = torch.device(
         "mps" if torch.backends.mps.is_available() else
@@ -52,38 +43,97 @@ class Config:
     LOCAL_FILES_PATH = os.environ.get("LOCAL_FILES_PATH")
     CONTAINER_PATH = os.environ.get("CONTAINER_PATH")
     QDRANT_COLLECTION = "mnm_storage"
+    QDRANT_FILE_PATH_KEY = "metadata.file_path"
     QDRANT_BOOTSTRAP = "qdrant"
+    SEARCH_LIMIT = int(os.environ.get("SEARCH_LIMIT", 4))
     EMBEDDING_MODEL_ID = os.environ.get("EMBEDDING_MODEL_ID")
     EMBEDDING_SIZE = os.environ.get("EMBEDDING_SIZE")
+    EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "torch").lower()
+    ONNX_MODEL_DIR = "/indexer/storage/onnx"
+    ONNX_QUANTIZE = os.environ.get("ONNX_QUANTIZE", "true").lower() in ("1", "true", "yes")
+    ONNX_INTRA_OP_THREADS = int(os.environ.get("ONNX_INTRA_OP_THREADS", 0))
+    ONNX_INTER_OP_THREADS = int(os.environ.get("ONNX_INTER_OP_THREADS", 0))
+    ONNX_MIN_COSINE = float(os.environ.get("ONNX_MIN_COSINE", 0.99))
+
+    INDEX_QUEUE_SIZE = int(os.environ.get("INDEX_QUEUE_SIZE", 10000))
+    WATCH_MODE = os.environ.get("WATCH_MODE", "false").lower() in ("1", "true", "yes")
+    CRAWL_INTERVAL_SECONDS = int(os.environ.get("CRAWL_INTERVAL_SECONDS", 60 * 20))
+    RECONCILE_INTERVAL_SECONDS = int(os.environ.get("RECONCILE_INTERVAL_SECONDS", 60 * 60 * 6))
     
     CHUNK_SIZE = 500
     CHUNK_OVERLAP = 200
 
+    PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", os.cpu_count() or 1))
+    PARSE_TIMEOUT_SECONDS = float(os.environ.get("PARSE_TIMEOUT_SECONDS", 300))
+    PARSE_MAX_TASKS_PER_CHILD = int(os.environ.get("PARSE_MAX_TASKS_PER_CHILD", 200))
+    STREAMING_THRESHOLD_BYTES = int(os.environ.get("STREAMING_THRESHOLD_BYTES", 32 * 1024 * 1024))
+    STREAMING_WINDOW_CHUNKS = int(os.environ.get("STREAMING_WINDOW_CHUNKS", 256))
+    STREAMING_TIMEOUT_SECONDS = float(os.environ.get("STREAMING_TIMEOUT_SECONDS", 1800))
+    PARSE_QUEUE_SIZE = int(os.environ.get("PARSE_QUEUE_SIZE", 64))
+    EMBED_QUEUE_SIZE = int(os.environ.get("EMBED_QUEUE_SIZE", 2048))
+    EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 256))
+    EMBED_BATCH_WAIT_SECONDS = float(os.environ.get("EMBED_BATCH_WAIT_SECONDS", 0.05))
+    UPSERT_QUEUE_SIZE = int(os.environ.get("UPSERT_QUEUE_SIZE", 2048))
+    UPSERT_BATCH_SIZE = int(os.environ.get("UPSERT_BATCH_SIZE", 256))
+
+    EMBEDDING_CACHE_FILE = "/indexer/storage/embeddings.db"
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 200000))
+    QUERY_CACHE_MAX_ENTRIES = int(os.environ.get("QUERY_CACHE_MAX_ENTRIES", 1024))
+    QUERY_CACHE_TTL_SECONDS = float(os.environ.get("QUERY_CACHE_TTL_SECONDS", 60 * 60 * 24))
+    EMBEDDING_MAX_BATCH_SIZE = int(os.environ.get("EMBEDDING_MAX_BATCH_SIZE", 64))
+    EMBEDDING_MAX_WAIT_SECONDS = float(os.environ.get("EMBEDDING_MAX_WAIT_SECONDS", 0.005))
+
 class Indexer:
     def __init__(self):
         self.config = Config()
         self.qdrant = self._initialize_qdrant()
+        # the request path awaits Qdrant instead of blocking the event loop the index loops share
+        self.async_qdrant = AsyncQdrantClient(host=self.config.QDRANT_BOOTSTRAP)
+        self.embedding_cache = EmbeddingCache(
+            file_name=self.config.EMBEDDING_CACHE_FILE,
+            max_entries=self.config.EMBEDDING_CACHE_MAX_ENTRIES
+        )
+        self.query_cache = QueryEmbeddingCache(
+            max_entries=self.config.QUERY_CACHE_MAX_ENTRIES,
+            ttl_seconds=self.config.QUERY_CACHE_TTL_SECONDS
+        )
         self.embed_model = self._initialize_embeddings()
-        self.document_store = self._setup_collection()
-        self.text_splitter = self._initialize_text_splitter()
+        self._setup_collection()
 
     def _initialize_qdrant(self) -> QdrantClient:
         return QdrantClient(host=self.config.QDRANT_BOOTSTRAP)
 
-    def _initialize_embeddings(self) -> HuggingFaceEmbeddings:
-        return HuggingFaceEmbeddings(
+    def _initialize_embeddings(self) -> CachedEmbeddings:
+        embeddings = HuggingFaceEmbeddings(
             model_name=self.config.EMBEDDING_MODEL_ID,
             model_kwargs={'device': self.config.DEVICE},
             encode_kwargs={'normalize_embeddings': False}
         )
-
-    def _initialize_text_splitter(self) -> RecursiveCharacterTextSplitter:
-        return RecursiveCharacterTextSplitter(
-            chunk_size=self.config.CHUNK_SIZE,
-            chunk_overlap=self.config.CHUNK_OVERLAP
+        model_id = self.config.EMBEDDING_MODEL_ID
+        if self.config.EMBEDDING_BACKEND == "onnx":
+            onnx_embeddings = load_onnx_embeddings(
+                embeddings,
+                model_id=self.config.EMBEDDING_MODEL_ID,
+                model_dir=self.config.ONNX_MODEL_DIR,
+                quantize=self.config.ONNX_QUANTIZE,
+                intra_op_threads=self.config.ONNX_INTRA_OP_THREADS,
+                inter_op_threads=self.config.ONNX_INTER_OP_THREADS,
+                min_cosine=self.config.ONNX_MIN_COSINE,
+            )
+            if onnx_embeddings is None:
+                logger.warning("Falling back to torch embeddings")
+            else:
+                embeddings = onnx_embeddings
+                # Quantized vectors differ slightly from torch ones, keep them apart in the cache.
+                model_id = f"{model_id}:onnx{'-int8' if self.config.ONNX_QUANTIZE else ''}"
+        return CachedEmbeddings(
+            embeddings,
+            cache=self.embedding_cache,
+            model_id=model_id,
+            query_cache=self.query_cache
         )
 
-    def _setup_collection(self) -> QdrantVectorStore:
+    def _setup_collection(self) -> None:
         if not self.qdrant.collection_exists(self.config.QDRANT_COLLECTION):
             self.qdrant.create_collection(
                 collection_name=self.config.QDRANT_COLLECTION,
@@ -94,83 +144,239 @@ class Indexer:
             )
         self.qdrant.create_payload_index(
             collection_name=self.config.QDRANT_COLLECTION,
-            field_name="fpath",
+            field_name=self.config.QDRANT_FILE_PATH_KEY,
             field_schema="keyword"
         )
-        return QdrantVectorStore(
-            client=self.qdrant,
-            collection_name=self.config.QDRANT_COLLECTION,
-            embedding=self.embed_model,
-        )
 
-    def _create_loader(self, file_path: str):
-        file_extension = Path(file_path).suffix.lower()
-        loader_class = self.config.EXTENSIONS_TO_LOADERS.get(file_extension)
-        
-        if not loader_class:
-            raise ValueError(f"Unsupported file type: {file_extension}")
-        
-        return loader_class(file_path=file_path)
+    def _chunk_ids(self, path: str, chunk_hashes: List[str], occurrences: Dict[str, int] | None = None) -> List[str]:
+        # The ordinal counts repeats of the same chunk text within the file, so
+        # inserting or removing text elsewhere keeps the ids of unchanged chunks.
+        occurrences = {} if occurrences is None else occurrences
+        ids = []
+        for chunk_hash in chunk_hashes:
+            ordinal = occurrences.get(chunk_hash, 0)
+            occurrences[chunk_hash] = ordinal + 1
+            ids.append(str(uuid.uuid5(POINT_ID_NAMESPACE, f"{path}\x00{ordinal}\x00{chunk_hash}")))
+        return ids
 
-    def _process_file(self, loader) -> List[str]:
-        try:
-            documents = loader.load_and_split(self.text_splitter)
-            if not documents:
-                logger.warning(f"No documents loaded from {loader.file_path}")
-                return []
+    def existing_ids(self, path: str) -> set[str]:
+        ids = set()
+        offset = None
+        while True:
+            records, offset = self.qdrant.scroll(
+                collection_name=self.config.QDRANT_COLLECTION,
+                scroll_filter=Filter(
+                    must=[FieldCondition(key=self.config.QDRANT_FILE_PATH_KEY, match=MatchValue(value=path))]
+                ),
+                offset=offset,
+                with_payload=False,
+                with_vectors=False,
+            )
+            ids.update(str(record.id) for record in records)
+            if offset is None:
+                return ids
+
+    def delete_points(self, stale_ids: List[str]) -> None:
+        if stale_ids:
+            self.qdrant.delete(
+                collection_name=self.config.QDRANT_COLLECTION,
+                points_selector=PointIdsList(points=stale_ids),
+                wait=True
+            )
 
-            for doc in documents:
-                doc.metadata['file_path'] = loader.file_path
+    def plan_window(
+        self,
+        path: str,
+        chunks: List[Chunk],
+        existing_ids: set[str],
+        occurrences: Dict[str, int]
+    ) -> Tuple[List[PendingChunk], List[str]]:
+        chunk_hashes = [text_hash(text) for text, _ in chunks]
+        chunk_ids = self._chunk_ids(path, chunk_hashes, occurrences)
+        new_chunks = []
+        for (text, metadata), chunk_hash, chunk_id in zip(chunks, chunk_hashes, chunk_ids):
+            if chunk_id in existing_ids:
+                continue
+            metadata = {**metadata, "file_path": path, "chunk_hash": chunk_hash}
+            new_chunks.append(PendingChunk(chunk_id=chunk_id, text=text, metadata=metadata))
+        return new_chunks, chunk_ids
 
-            uuids = [str(uuid.uuid4()) for _ in range(len(documents))]
-            ids = self.document_store.add_documents(documents=documents, ids=uuids)
-            
-            logger.info(f"Successfully processed {len(ids)} documents from {loader.file_path}")
-            return ids
-            
-        except Exception as e:
-            logger.error(f"Error processing file {loader.file_path}: {str(e)}")
+    def plan_chunks(self, path: str, chunks: List[Chunk]) -> Tuple[List[PendingChunk], List[str]]:
+        existing_ids = self.existing_ids(path)
+        new_chunks, chunk_ids = self.plan_window(path, chunks, existing_ids, occurrences={})
+        stale_ids = list(existing_ids.difference(chunk_ids))
+        if not chunks:
+            logger.warning(f"No documents loaded from {path}")
+        logger.info(
+            f"Planned {len(chunks)} documents from {path}: {len(new_chunks)} to embed, "
+            f"{len(chunk_ids) - len(new_chunks)} unchanged, {len(stale_ids)} to remove"
+        )
+        return new_chunks, stale_ids
+
+    def upsert_points(self, chunks: List[PendingChunk], vectors: List[List[float]]) -> None:
+        self.qdrant.upsert(
+            collection_name=self.config.QDRANT_COLLECTION,
+            points=[
+                PointStruct(
+                    id=chunk.chunk_id,
+                    vector=vector,
+                    payload={
+                        QdrantVectorStore.CONTENT_KEY: chunk.text,
+                        QdrantVectorStore.METADATA_KEY: chunk.metadata,
+                    }
+                )
+                for chunk, vector in zip(chunks, vectors)
+            ],
+            wait=True
+        )
+
+    def _copy_from_duplicate(self, path: str, content_hash: str, is_busy: Callable[[str], bool]) -> List[str]:
+        # Points of a path that is being prepared or indexed may be partly written or stale.
+        duplicate_path = next(
+            (duplicate for duplicate in MinimaStore.find_duplicates(path, content_hash) if not is_busy(duplicate)),
+            None
+        )
+        if duplicate_path is None:
             return []
+        payloads = []
+        vectors = []
+        offset = None
+        while True:
+            records, offset = self.qdrant.scroll(
+                collection_name=self.config.QDRANT_COLLECTION,
+                scroll_filter=Filter(
+                    must=[FieldCondition(key=self.config.QDRANT_FILE_PATH_KEY, match=MatchValue(value=duplicate_path))]
+                ),
+                offset=offset,
+                with_payload=True,
+                with_vectors=True,
+            )
+            for record in records:
+                payload = dict(record.payload)
+                metadata = {
+                    key: path if value == duplicate_path else value
+                    for key, value in payload.get("metadata", {}).items()
+                }
+                metadata.setdefault("chunk_hash", text_hash(payload.get("page_content", "")))
+                payload["metadata"] = metadata
+                payloads.append(payload)
+                vectors.append(record.vector)
+            if offset is None:
+                break
+        if not payloads:
+            return []
+        chunk_ids = self._chunk_ids(path, [payload["metadata"]["chunk_hash"] for payload in payloads])
+        existing_ids = self.existing_ids(path)
+        self.qdrant.upsert(
+            collection_name=self.config.QDRANT_COLLECTION,
+            points=[
+                PointStruct(id=chunk_id, vector=vector, payload=payload)
+                for chunk_id, vector, payload in zip(chunk_ids, vectors, payloads)
+            ],
+            wait=True
+        )
+        self.delete_points(list(existing_ids.difference(chunk_ids)))
+        logger.info(f"Reused {len(chunk_ids)} vectors of identical file {duplicate_path} for {path}")
+        return chunk_ids
 
-    def index(self, message: Dict[str, any]) -> None:
+    def prepare_batch(
+        self,
+        messages: List[Dict[str, any]],
+        is_busy: Callable[[str], bool]
+    ) -> Tuple[List[Tuple[str, int, str]], List[str]]:
+        # Returns the files to parse and the files that could not be checked, which need a retry.
         start = time.time()
-        path, file_id, last_updated_seconds = message["path"], message["file_id"], message["last_updated_seconds"]
-        logger.info(f"Processing file: {path} (ID: {file_id})")
-        indexing_status: IndexingStatus = MinimaStore.check_needs_indexing(fpath=path, last_updated_seconds=last_updated_seconds)
-        if indexing_status != IndexingStatus.no_need_reindexing:
+        last_updated = {message["path"]: message["last_updated_seconds"] for message in messages}
+        logger.info(f"Checking {len(last_updated)} files for changes")
+        statuses = MinimaStore.check_needs_indexing_batch(list(last_updated.items()))
+        unchanged_docs = []
+        candidates = []
+        failed_paths = []
+        for path, (indexing_status, stored_hash) in statuses.items():
+            if indexing_status == IndexingStatus.no_need_reindexing:
+                logger.info(f"Skipping {path}, no indexing required. timestamp didn't change")
+                continue
+            if indexing_status == IndexingStatus.error:
+                failed_paths.append(path)
+                continue
+            try:
+                content_hash = file_content_hash(path)
+            except OSError as e:
+                logger.error(f"Failed to read file {path}: {str(e)}")
+                failed_paths.append(path)
+                continue
+            if content_hash == stored_hash:
+                logger.info(f"Skipping {path}, no indexing required. content didn't change")
+                unchanged_docs.append((path, last_updated[path], content_hash))
+                continue
             logger.info(f"Indexing needed for {path} with status: {indexing_status}")
+            candidates.append((path, last_updated[path], content_hash))
+
+        # The hash of a file to parse is stored by the pipeline once all of its points are written.
+        copied_docs = []
+        files_to_parse = []
+        for doc in candidates:
+            path, _, content_hash = doc
             try:
-                if indexing_status == IndexingStatus.need_reindexing:
-                    logger.info(f"Removing {path} from index storage for reindexing")
-                    self.remove_from_storage(files_to_remove=[path])
-                loader = self._create_loader(path)
-                ids = self._process_file(loader)
-                if ids:
-                    logger.info(f"Successfully indexed {path} with IDs: {ids}")
+                if self._copy_from_duplicate(path, content_hash, is_busy):
+                    copied_docs.append(doc)
+                    continue
             except Exception as e:
-                logger.error(f"Failed to index file {path}: {str(e)}")
-        else:
-            logger.info(f"Skipping {path}, no indexing required. timestamp didn't change")
+                logger.error(f"Failed to reuse vectors for file {path}: {str(e)}")
+            files_to_parse.append(doc)
+        try:
+            MinimaStore.update_docs(unchanged_docs + copied_docs)
+        except Exception as e:
+            logger.error(f"Failed to record {len(unchanged_docs) + len(copied_docs)} checked files: {str(e)}")
+            failed_paths.extend(path for path, _, _ in unchanged_docs + copied_docs)
         end = time.time()
-        logger.info(f"Processing took {end - start} seconds for file {path}")
+        logger.info(
+            f"Change detection took {end - start} seconds for {len(last_updated)} files, "
+            f"{len(files_to_parse)} to parse, {len(failed_paths)} failed"
+        )
+        return files_to_parse, failed_paths
+
+    def record_indexed(self, docs: List[Tuple[str, int, str]]) -> None:
+        MinimaStore.update_docs(docs)
+
+    def mark_failed(self, docs: List[Tuple[str, int]]) -> None:
+        # A row without a hash is indexed again on its next check, and purged if the file is gone.
+        MinimaStore.update_docs([(path, last_updated_seconds, None) for path, last_updated_seconds in docs])
 
     def purge(self, message: Dict[str, any]) -> None:
-        existing_file_paths: list[str] = message["existing_file_paths"]
-        files_to_remove = MinimaStore.find_removed_files(existing_file_paths=set(existing_file_paths))
+        # The watcher and requests index files while a crawl runs, so a file missing from the
+        # crawl is only removed if it is missing from disk too.
+        not_crawled = MinimaStore.find_removed_files(crawl_id=message["crawl_id"])
+        files_to_remove = [path for path in not_crawled if not os.path.exists(path)]
         if len(files_to_remove) > 0:
-            logger.info(f"purge processing removing old files {files_to_remove}")
+            logger.info(f"purge processing removing {len(files_to_remove)} old files")
+            MinimaStore.delete_m_docs(files_to_remove)
             self.remove_from_storage(files_to_remove)
         else:
             logger.info("Nothing to purge")
 
+    def remove(self, message: Dict[str, any]) -> None:
+        # Removals sort after file messages, so a file deleted and created again can be indexed
+        # before its removal is handled. What is on disk now decides.
+        removed_file_paths = [path for path in message["removed_file_paths"] if not os.path.exists(path)]
+        skipped = len(message["removed_file_paths"]) - len(removed_file_paths)
+        if skipped:
+            logger.info(f"Keeping {skipped} removed files that exist again")
+        if not removed_file_paths:
+            return
+        logger.info(f"Removing {len(removed_file_paths)} deleted files")
+        MinimaStore.delete_m_docs(removed_file_paths)
+        self.remove_from_storage(removed_file_paths)
+
     def remove_from_storage(self, files_to_remove: list[str]):
+        if not files_to_remove:
+            return
         filter_conditions = Filter(
             must=[
                 FieldCondition(
-                    key="fpath",
-                    match=MatchValue(value=fpath)
+                    key=self.config.QDRANT_FILE_PATH_KEY,
+                    match=MatchAny(any=files_to_remove)
                 )
-                for fpath in files_to_remove
             ]
         )
         response = self.qdrant.delete(
@@ -178,12 +384,18 @@ class Indexer:
             points_selector=filter_conditions,
             wait=True
         )
-        logger.info(f"Delete response for {len(files_to_remove)} for files: {files_to_remove} is: {response}")
+        logger.info(f"Delete response for {len(files_to_remove)} files is: {response}")
 
-    def find(self, query: str) -> Dict[str, any]:
+    async def find(self, query: str, query_vector: List[float]) -> Dict[str, any]:
         try:
             logger.info(f"Searching for: {query}")
-            found = self.document_store.search(query, search_type="similarity")
+            response = await self.async_qdrant.query_points(
+                collection_name=self.config.QDRANT_COLLECTION,
+                query=query_vector,
+                limit=self.config.SEARCH_LIMIT,
+                with_payload=True,
+            )
+            found = response.points
             
             if not found:
                 logger.info("No results found")
@@ -193,12 +405,13 @@ class Indexer:
             results = []
             
             for item in found:
-                path = item.metadata["file_path"].replace(
+                metadata = item.payload.get(QdrantVectorStore.METADATA_KEY) or {}
+                path = metadata["file_path"].replace(
                     self.config.CONTAINER_PATH,
                     self.config.LOCAL_FILES_PATH
                 )
                 links.add(f"file://{path}")
-                results.append(item.page_content)
+                results.append(item.payload.get(QdrantVectorStore.CONTENT_KEY, ""))
 
             output = {
                 "links": links,
@@ -212,5 +425,5 @@ class Indexer:
             logger.error(f"Search failed: {str(e)}")
             return {"error": "Unable to find anything for the given query"}
 
-    def embed(self, query: str):
-        return self.embed_model.embed_query(query)
\ No newline at end of file
+    def embed_batch(self, queries: List[str]) -> List[List[float]]:
+        return self.embed_model.embed_queries(queries)
\ No newline at end of file
@@ -0,0 +1,96 @@
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.document_loaders import (
+    TextLoader,
+    CSVLoader,
+    Docx2txtLoader,
+    UnstructuredExcelLoader,
+    PyMuPDFLoader,
+    UnstructuredPowerPointLoader,
+)
+
+EXTENSIONS_TO_LOADERS = {
+    ".pdf": PyMuPDFLoader,
+    ".pptx": UnstructuredPowerPointLoader,
+    ".ppt": UnstructuredPowerPointLoader,
+    ".xls": UnstructuredExcelLoader,
+    ".xlsx": UnstructuredExcelLoader,
+    ".docx": Docx2txtLoader,
+    ".doc": Docx2txtLoader,
+    ".txt": TextLoader,
+    ".md": TextLoader,
+    ".csv": CSVLoader,
+}
+
+TEXT_EXTENSIONS = {".txt", ".md"}
+# PDF pages and CSV rows are loaded lazily and text is read in blocks. The Word, Excel and
+# PowerPoint loaders read a whole document, so those files are parsed whole in a parser
+# process however large they are, and need memory in proportion to their text.
+STREAMING_EXTENSIONS = {".pdf", ".csv", *TEXT_EXTENSIONS}
+TEXT_READ_CHARS = 1024 * 1024
+
+# (page_content, metadata)
+Chunk = Tuple[str, dict]
+
+
+def create_loader(file_path: str):
+    file_extension = Path(file_path).suffix.lower()
+    loader_class = EXTENSIONS_TO_LOADERS.get(file_extension)
+
+    if not loader_class:
+        raise ValueError(f"Unsupported file type: {file_extension}")
+
+    return loader_class(file_path=file_path)
+
+
+# Runs in a parser worker process, so only plain texts and metadata go back to the indexer.
+def load_chunks(file_path: str, chunk_size: int, chunk_overlap: int) -> List[Chunk]:
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    documents = create_loader(file_path).load_and_split(text_splitter)
+    return [(doc.page_content, doc.metadata) for doc in documents]
+
+
+def is_streamable(file_path: str) -> bool:
+    return Path(file_path).suffix.lower() in STREAMING_EXTENSIONS
+
+
+# TextLoader reads a whole file, so text is read in blocks cut at their last line break,
+# the rest of a block is carried over to the next one.
+def _iter_text_chunks(file_path: str, text_splitter) -> Iterator[Chunk]:
+    rest = ""
+    with open(file_path) as file:
+        while True:
+            block = file.read(TEXT_READ_CHARS)
+            text = rest + block
+            cut = text.rfind("\n") + 1 if block else 0
+            if cut == 0:
+                cut = len(text)
+            text, rest = text[:cut], text[cut:]
+            for doc in text_splitter.create_documents([text], [{"source": file_path}]):
+                yield doc.page_content, doc.metadata
+            if not block:
+                return
+
+
+# Streams a file page by page, row by row or block by block and yields chunks in windows of
+# window_size, so only one window of a huge document is held in memory at a time.
+def iter_chunk_windows(file_path: str, chunk_size: int, chunk_overlap: int, window_size: int) -> Iterator[List[Chunk]]:
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    if Path(file_path).suffix.lower() in TEXT_EXTENSIONS:
+        chunks = _iter_text_chunks(file_path, text_splitter)
+    else:
+        chunks = (
+            (doc.page_content, doc.metadata)
+            for document in create_loader(file_path).lazy_load()
+            for doc in text_splitter.split_documents([document])
+        )
+    window: List[Chunk] = []
+    for chunk in chunks:
+        window.append(chunk)
+        if len(window) >= window_size:
+            yield window
+            window = []
+    if window:
+        yield window
@@ -0,0 +1,155 @@
+import os
+import copy
+import logging
+from typing import List
+
+import numpy as np
+import torch
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+
+logger = logging.getLogger(__name__)
+
+ONNX_BATCH_SIZE = 32
+ONNX_OPSET_VERSION = 14
+PARITY_SAMPLE = [
+    "Minima indexes local documents for retrieval.",
+    "id,name,amount",
+    "Quarterly report",
+    "The quick brown fox jumps over the lazy dog while the indexer keeps embedding chunks of text "
+    "from markdown files, spreadsheets, presentations and PDF documents stored on the local disk.",
+    "def find(self, query: str) -> Dict[str, any]:",
+]
+
+
+class _SentenceEmbeddingModule(torch.nn.Module):
+
+    def __init__(self, model: torch.nn.Module, input_names: List[str]):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        return self.model(dict(zip(self.input_names, inputs)))["sentence_embedding"]
+
+
+class OnnxEmbeddings(Embeddings):
+
+    def __init__(self, model_file: str, tokenizer, max_seq_length: int, intra_op_threads: int, inter_op_threads: int):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads > 0:
+            options.inter_op_num_threads = inter_op_threads
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+
+    def _run(self, features) -> np.ndarray:
+        inputs = {name: np.asarray(features[name], dtype=np.int64) for name in self.input_names}
+        return self.session.run(None, inputs)[0]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # A batch is padded to its longest text. SentenceTransformer.encode sorts by length
+        # for the torch backend, here texts are tokenized once, sorted by token count and
+        # padded per batch, then put back in the original order.
+        if not texts:
+            return []
+        features = self.tokenizer(texts, truncation=True, max_length=self.max_seq_length)
+        order = sorted(range(len(texts)), key=lambda i: len(features["input_ids"][i]))
+        vectors: List[List[float] | None] = [None] * len(texts)
+        for i in range(0, len(order), ONNX_BATCH_SIZE):
+            batch = order[i:i + ONNX_BATCH_SIZE]
+            padded = self.tokenizer.pad(
+                {name: [features[name][j] for j in batch] for name in features.keys()},
+                return_tensors="np"
+            )
+            for position, vector in zip(batch, self._run(padded).tolist()):
+                vectors[position] = vector
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def _export(model, model_file: str) -> None:
+    # The whole sentence-transformers module (transformer, pooling, normalization) is
+    # exported, so the graph returns the same sentence embedding the torch model does.
+    model = copy.deepcopy(model).to("cpu").eval()
+    sample = model.tokenizer(["export sample"], return_tensors="pt")
+    input_names = list(sample.keys())
+    tmp_file = f"{model_file}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            _SentenceEmbeddingModule(model, input_names),
+            tuple(sample[name] for name in input_names),
+            tmp_file,
+            input_names=input_names,
+            output_names=["sentence_embedding"],
+            dynamic_axes={
+                **{name: {0: "batch", 1: "sequence"} for name in input_names},
+                "sentence_embedding": {0: "batch"},
+            },
+            opset_version=ONNX_OPSET_VERSION,
+        )
+    os.replace(tmp_file, model_file)
+
+
+def _quantize(model_file: str, quantized_file: str) -> None:
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    tmp_file = f"{quantized_file}.tmp"
+    quantize_dynamic(model_file, tmp_file, weight_type=QuantType.QInt8)
+    os.replace(tmp_file, quantized_file)
+
+
+def _min_cosine(expected: List[List[float]], actual: List[List[float]]) -> float:
+    expected = np.asarray(expected, dtype=np.float32)
+    actual = np.asarray(actual, dtype=np.float32)
+    similarity = (expected * actual).sum(axis=1) / (
+        np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1)
+    )
+    return float(similarity.min())
+
+
+def load_onnx_embeddings(
+    embeddings: HuggingFaceEmbeddings,
+    model_id: str,
+    model_dir: str,
+    quantize: bool,
+    intra_op_threads: int,
+    inter_op_threads: int,
+    min_cosine: float,
+) -> Embeddings | None:
+    model = embeddings.client
+    export_dir = os.path.join(model_dir, model_id.replace("/", "__"))
+    model_file = os.path.join(export_dir, "model.onnx")
+    quantized_file = os.path.join(export_dir, "model_int8.onnx")
+    try:
+        os.makedirs(export_dir, exist_ok=True)
+        if not os.path.exists(model_file):
+            logger.info(f"Exporting {model_id} to ONNX: {model_file}")
+            _export(model, model_file)
+        if quantize and not os.path.exists(quantized_file):
+            logger.info(f"Quantizing {model_file} to int8: {quantized_file}")
+            _quantize(model_file, quantized_file)
+        onnx_embeddings = OnnxEmbeddings(
+            model_file=quantized_file if quantize else model_file,
+            tokenizer=model.tokenizer,
+            max_seq_length=model.max_seq_length,
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=inter_op_threads,
+        )
+        cosine = _min_cosine(embeddings.embed_documents(PARITY_SAMPLE), onnx_embeddings.embed_documents(PARITY_SAMPLE))
+    except Exception as e:
+        logger.error(f"Failed to load ONNX embeddings for {model_id}: {e}")
+        return None
+    if cosine < min_cosine:
+        logger.error(f"ONNX embeddings for {model_id} failed the parity check: cosine {cosine:.4f} < {min_cosine}")
+        return None
+    logger.info(f"Using ONNX Runtime embeddings for {model_id} (quantized: {quantize}, parity cosine {cosine:.4f})")
+    return onnx_embeddings
@@ -0,0 +1,114 @@
+import time
+import queue
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+# windows a streaming parser process may have ready before it waits for the indexer
+STREAM_QUEUE_WINDOWS = 2
+
+
+class ParseTimeout(Exception):
+
+    def __init__(self, message="Parsing timed out"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class ParserPool:
+
+    def __init__(self, max_workers: int, timeout_seconds: float, max_tasks_per_child: int, attempts: int = 2):
+        self.max_workers = max_workers
+        self.timeout_seconds = timeout_seconds
+        self.max_tasks_per_child = max_tasks_per_child
+        self.attempts = attempts
+        self.recycled = 0
+        self._executor = self._create_executor()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            max_tasks_per_child=self.max_tasks_per_child
+        )
+
+    def _recycle(self, executor: ProcessPoolExecutor, reason: str) -> None:
+        if executor is not self._executor:
+            return
+        logger.warning(f"Recycling parser pool: {reason}")
+        self.recycled += 1
+        self._executor = self._create_executor()
+        # A hung or runaway worker never returns on its own, shutdown() alone would leave it running.
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def run(self, fn, path: str, *args):
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, self.attempts + 1):
+            executor = self._executor
+            try:
+                return await asyncio.wait_for(loop.run_in_executor(executor, fn, path, *args), self.timeout_seconds)
+            except asyncio.TimeoutError:
+                self._recycle(executor, reason=f"parsing {path} exceeded {self.timeout_seconds}s")
+                raise ParseTimeout(f"Parsing {path} timed out after {self.timeout_seconds}s")
+            except BrokenProcessPool:
+                # Every task of a broken pool fails, not only the one that crashed it, so retry on a fresh pool.
+                self._recycle(executor, reason="worker process died")
+                if attempt == self.attempts:
+                    raise
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _stream_windows(fn, args: tuple, windows) -> None:
+    try:
+        for window in fn(*args):
+            windows.put(("window", window))
+        windows.put(("done", None))
+    except Exception as e:
+        windows.put(("error", f"{type(e).__name__}: {e}"))
+
+
+# Runs a generator of chunk windows in its own process, so a hung or crashing parser of a huge
+# file can be killed without taking the indexer or its threads with it. The bounded queue holds
+# the process back until the indexer took its previous windows.
+class WindowStream:
+
+    def __init__(self, fn, path: str, *args):
+        context = multiprocessing.get_context("spawn")
+        self.path = path
+        self._windows = context.Queue(maxsize=STREAM_QUEUE_WINDOWS)
+        self._process = context.Process(
+            target=_stream_windows, args=(fn, (path, *args), self._windows), daemon=True
+        )
+        self._process.start()
+
+    def next_window(self, timeout_seconds: float) -> list | None:
+        # Blocks for at most a second past the timeout, returns None once the file is done.
+        deadline = time.monotonic() + timeout_seconds
+        while True:
+            try:
+                kind, value = self._windows.get(timeout=min(max(deadline - time.monotonic(), 0), 1.0))
+            except queue.Empty:
+                if not self._process.is_alive():
+                    raise RuntimeError(f"Parser process for {self.path} died with exit code {self._process.exitcode}")
+                if time.monotonic() >= deadline:
+                    raise ParseTimeout(f"Streaming {self.path} timed out")
+                continue
+            if kind == "window":
+                return value
+            if kind == "error":
+                raise RuntimeError(value)
+            return None
+
+    def close(self) -> None:
+        if self._process.is_alive():
+            self._process.kill()
+        self._process.join()
+        self._windows.close()
@@ -0,0 +1,353 @@
+import os
+import time
+import asyncio
+import logging
+import itertools
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+
+from loaders import load_chunks, iter_chunk_windows, is_streamable
+from parser_pool import ParserPool, ParseTimeout, WindowStream
+from indexer import Indexer, PendingChunk
+
+logger = logging.getLogger(__name__)
+
+
+# A file's chunks can be spread over many embed and upsert batches, so the file is only
+# done once it is parsed and every chunk is written, and it failed if any of them failed.
+@dataclass(eq=False)
+class FileJob:
+    path: str
+    last_updated_seconds: int
+    content_hash: str
+    priority: tuple = ()
+    live: bool = False
+    pending: int = 0
+    parsed: bool = False
+    failed: bool = False
+    stale_ids: List[str] = field(default_factory=list)
+
+    def is_done(self) -> bool:
+        return self.parsed and self.pending == 0
+
+
+@dataclass
+class StageStats:
+    items: int = 0
+    errors: int = 0
+    busy_seconds: float = 0.0
+
+    def record(self, items: int, seconds: float) -> None:
+        self.items += items
+        self.busy_seconds += seconds
+
+    def as_dict(self, queue: asyncio.Queue | None = None) -> dict:
+        stats = {
+            "items": self.items,
+            "errors": self.errors,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "items_per_second": round(self.items / self.busy_seconds, 2) if self.busy_seconds else 0.0,
+        }
+        if queue is not None:
+            stats["queued"] = queue.qsize()
+        return stats
+
+
+# parse (process pool) -> embed (batches across files) -> upsert (batched), joined by bounded queues.
+# Parse and embed are ordered by file priority, and live work (watcher events, requests) has its
+# own slots in them, so it never waits behind a backfill that fills the queues.
+class IndexPipeline:
+
+    def __init__(self, indexer: Indexer):
+        self.indexer = indexer
+        self.config = indexer.config
+        self.parse_queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.embed_queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.upsert_queue: asyncio.Queue = asyncio.Queue(maxsize=self.config.UPSERT_QUEUE_SIZE)
+        self._parse_slots = {live: asyncio.Semaphore(self.config.PARSE_QUEUE_SIZE) for live in (False, True)}
+        self._embed_slots = {live: asyncio.Semaphore(self.config.EMBED_QUEUE_SIZE) for live in (False, True)}
+        self._order = itertools.count()
+        self.parser_pool = ParserPool(
+            max_workers=self.config.PARSE_WORKERS,
+            timeout_seconds=self.config.PARSE_TIMEOUT_SECONDS,
+            max_tasks_per_child=self.config.PARSE_MAX_TASKS_PER_CHILD
+        )
+        self.thread_pool = ThreadPoolExecutor(max_workers=self.config.PARSE_WORKERS + 2)
+        # waits on streaming parser processes, apart from the embed and upsert calls
+        self.stream_pool = ThreadPoolExecutor(max_workers=self.config.PARSE_WORKERS, thread_name_prefix="stream")
+        self.stats = {"parse": StageStats(), "embed": StageStats(), "upsert": StageStats()}
+        # files that failed in any stage since the last crawl, kept out of its snapshot
+        self.failed_paths: set[str] = set()
+        # paths being prepared or indexed, their points may be partly written
+        self._busy: Counter[str] = Counter()
+        self._released = asyncio.Event()
+        self._parsing = 0
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.create_task(self._parse_worker())
+            for _ in range(self.config.PARSE_WORKERS)
+        ]
+        self._tasks.append(asyncio.create_task(self._embed_worker()))
+        self._tasks.append(asyncio.create_task(self._upsert_worker()))
+        logger.info(f"Index pipeline started with {self.config.PARSE_WORKERS} parse workers")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.parser_pool.shutdown()
+        self.thread_pool.shutdown(wait=False, cancel_futures=True)
+        self.stream_pool.shutdown(wait=False, cancel_futures=True)
+
+    async def submit(
+        self,
+        path: str,
+        last_updated_seconds: int,
+        content_hash: str,
+        priority: tuple = (),
+        live: bool = False
+    ) -> None:
+        job = FileJob(
+            path=path,
+            last_updated_seconds=last_updated_seconds,
+            content_hash=content_hash,
+            priority=priority,
+            live=live
+        )
+        await self._parse_slots[live].acquire()
+        self.reserve([path])
+        self.parse_queue.put_nowait((priority, next(self._order), job))
+
+    def reserve(self, paths: List[str]) -> None:
+        self._busy.update(paths)
+
+    def release(self, paths: List[str]) -> None:
+        self._busy.subtract(paths)
+        for path in paths:
+            if self._busy.get(path, 1) <= 0:
+                del self._busy[path]
+        self._released.set()
+        self._released = asyncio.Event()
+
+    def is_busy(self, path: str) -> bool:
+        return path in self._busy
+
+    def busy_under(self, dir_paths: List[str]) -> List[str]:
+        prefixes = tuple(os.path.join(dir_path, "") for dir_path in dir_paths)
+        return [path for path in self._busy if path.startswith(prefixes)]
+
+    async def wait_for(self, paths: List[str]) -> None:
+        # Waits until no batch being prepared and no file in the pipeline still works on these paths.
+        while any(path in self._busy for path in paths):
+            await self._released.wait()
+
+    def take_failed_paths(self) -> set[str]:
+        failed_paths, self.failed_paths = self.failed_paths, set()
+        return failed_paths
+
+    async def join(self) -> None:
+        # Every stage hands its output downstream before marking its input done,
+        # so joining the queues in order waits for all submitted files.
+        await self.parse_queue.join()
+        await self.embed_queue.join()
+        await self.upsert_queue.join()
+        logger.info(f"Index pipeline drained: {self.get_stats()}")
+
+    def get_stats(self) -> dict:
+        return {
+            "parse": {**self.stats["parse"].as_dict(self.parse_queue), "pool_recycled": self.parser_pool.recycled},
+            "embed": self.stats["embed"].as_dict(self.embed_queue),
+            "upsert": self.stats["upsert"].as_dict(self.upsert_queue),
+            "failed_files": len(self.failed_paths),
+        }
+
+    async def _finish(self, jobs: List[FileJob]) -> None:
+        try:
+            await self._record(jobs)
+        finally:
+            self.release([job.path for job in jobs])
+
+    async def _record(self, jobs: List[FileJob]) -> None:
+        # Old points of a file are deleted and its hash stored only once all of its new chunks are
+        # written. A failed file keeps them and loses its hash, so the next crawl or event indexes it again.
+        loop = asyncio.get_running_loop()
+        succeeded = [job for job in jobs if not job.failed]
+        failed = [job for job in jobs if job.failed]
+        stale_ids = [point_id for job in succeeded for point_id in job.stale_ids]
+        try:
+            if stale_ids:
+                await loop.run_in_executor(self.thread_pool, self.indexer.delete_points, stale_ids)
+        except Exception as e:
+            self.stats["upsert"].errors += 1
+            logger.error(f"Error removing {len(stale_ids)} stale points: {str(e)}")
+            failed.extend(succeeded)
+            succeeded = []
+        try:
+            if succeeded:
+                docs = [(job.path, job.last_updated_seconds, job.content_hash) for job in succeeded]
+                await loop.run_in_executor(self.thread_pool, self.indexer.record_indexed, docs)
+        except Exception as e:
+            logger.error(f"Failed to record {len(succeeded)} indexed files: {str(e)}")
+            failed.extend(succeeded)
+        if not failed:
+            return
+        paths = [job.path for job in failed]
+        self.failed_paths.update(paths)
+        logger.warning(f"Indexing failed for {len(paths)} files, marked for retry: {paths}")
+        try:
+            docs = [(job.path, job.last_updated_seconds) for job in failed]
+            await loop.run_in_executor(self.thread_pool, self.indexer.mark_failed, docs)
+        except Exception as e:
+            logger.error(f"Failed to mark {len(paths)} files for retry: {str(e)}")
+
+    async def _settle(self, jobs) -> None:
+        done = [job for job in dict.fromkeys(jobs) if job.is_done()]
+        if done:
+            await self._finish(done)
+
+    async def _put_chunks(self, job: FileJob, chunks: List[PendingChunk]) -> None:
+        for chunk in chunks:
+            await self._embed_slots[job.live].acquire()
+            job.pending += 1
+            self.embed_queue.put_nowait((job.priority, next(self._order), job, chunk))
+
+    async def _parse_file(self, job: FileJob) -> None:
+        loop = asyncio.get_running_loop()
+        path = job.path
+        start = time.perf_counter()
+        chunks = await self.parser_pool.run(
+            load_chunks, path, self.config.CHUNK_SIZE, self.config.CHUNK_OVERLAP
+        )
+        self.stats["parse"].record(len(chunks), time.perf_counter() - start)
+        new_chunks, stale_ids = await loop.run_in_executor(
+            self.thread_pool, self.indexer.plan_chunks, path, chunks
+        )
+        await self._put_chunks(job, new_chunks)
+        job.stale_ids = stale_ids
+
+    async def _parse_worker(self) -> None:
+        while True:
+            _, _, job = await self.parse_queue.get()
+            self._parse_slots[job.live].release()
+            self._parsing += 1
+            try:
+                if os.path.getsize(job.path) >= self.config.STREAMING_THRESHOLD_BYTES and is_streamable(job.path):
+                    await self._stream_file(job)
+                else:
+                    await self._parse_file(job)
+            except Exception as e:
+                self.stats["parse"].errors += 1
+                job.failed = True
+                logger.error(f"Error processing file {job.path}: {str(e)}")
+            finally:
+                job.parsed = True
+                self._parsing -= 1
+                try:
+                    await self._settle([job])
+                finally:
+                    self.parse_queue.task_done()
+
+    async def _stream_file(self, job: FileJob) -> None:
+        loop = asyncio.get_running_loop()
+        path = job.path
+        logger.info(f"Streaming large file {path} in windows of {self.config.STREAMING_WINDOW_CHUNKS} chunks")
+        existing_ids = await loop.run_in_executor(self.thread_pool, self.indexer.existing_ids, path)
+        # Huge files are parsed in their own process like any other file, only window by window.
+        stream = await loop.run_in_executor(
+            self.stream_pool, WindowStream, iter_chunk_windows,
+            path, self.config.CHUNK_SIZE, self.config.CHUNK_OVERLAP, self.config.STREAMING_WINDOW_CHUNKS
+        )
+        occurrences: dict[str, int] = {}
+        seen_ids: set[str] = set()
+        # Only time spent reading the file counts against the deadline, not waiting for embed slots.
+        remaining = self.config.STREAMING_TIMEOUT_SECONDS
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    window = await loop.run_in_executor(self.stream_pool, stream.next_window, remaining)
+                except ParseTimeout:
+                    raise ParseTimeout(f"Streaming {path} timed out after {self.config.STREAMING_TIMEOUT_SECONDS}s")
+                elapsed = time.perf_counter() - start
+                remaining -= elapsed
+                if window is None:
+                    break
+                self.stats["parse"].record(len(window), elapsed)
+                new_chunks, chunk_ids = self.indexer.plan_window(path, window, existing_ids, occurrences)
+                seen_ids.update(chunk_ids)
+                # The embed slots block here until the previous windows are embedded.
+                await self._put_chunks(job, new_chunks)
+        finally:
+            await loop.run_in_executor(self.stream_pool, stream.close)
+        stale_ids = list(existing_ids.difference(seen_ids))
+        job.stale_ids = stale_ids
+        logger.info(f"Streamed {len(seen_ids)} chunks from {path}, {len(stale_ids)} to remove")
+
+    @staticmethod
+    def _drain(queue: asyncio.Queue, batch: list, limit: int) -> None:
+        while len(batch) < limit:
+            try:
+                batch.append(queue.get_nowait())
+            except asyncio.QueueEmpty:
+                return
+
+    async def _embed_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        batch_size = self.config.EMBED_BATCH_SIZE
+        while True:
+            batch = [await self.embed_queue.get()]
+            self._drain(self.embed_queue, batch, batch_size)
+            if len(batch) < batch_size and self._parsing:
+                # Parsers are still producing, give them a moment to fill the batch.
+                await asyncio.sleep(self.config.EMBED_BATCH_WAIT_SECONDS)
+                self._drain(self.embed_queue, batch, batch_size)
+            for _, _, job, _ in batch:
+                self._embed_slots[job.live].release()
+            try:
+                start = time.perf_counter()
+                vectors = await loop.run_in_executor(
+                    self.thread_pool,
+                    self.indexer.embed_model.embed_documents,
+                    [chunk.text for _, _, _, chunk in batch]
+                )
+                self.stats["embed"].record(len(batch), time.perf_counter() - start)
+                for (_, _, job, chunk), vector in zip(batch, vectors):
+                    await self.upsert_queue.put((job, chunk, vector))
+            except Exception as e:
+                self.stats["embed"].errors += 1
+                logger.error(f"Error embedding {len(batch)} chunks: {str(e)}")
+                for _, _, job, _ in batch:
+                    job.failed = True
+                    job.pending -= 1
+                await self._settle(job for _, _, job, _ in batch)
+            finally:
+                for _ in batch:
+                    self.embed_queue.task_done()
+
+    async def _upsert_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        batch_size = self.config.UPSERT_BATCH_SIZE
+        while True:
+            batch = [await self.upsert_queue.get()]
+            self._drain(self.upsert_queue, batch, batch_size)
+            try:
+                start = time.perf_counter()
+                _, chunks, vectors = zip(*batch)
+                await loop.run_in_executor(self.thread_pool, self.indexer.upsert_points, chunks, vectors)
+                self.stats["upsert"].record(len(batch), time.perf_counter() - start)
+            except Exception as e:
+                self.stats["upsert"].errors += 1
+                logger.error(f"Error writing {len(batch)} points to storage: {str(e)}")
+                for job, _, _ in batch:
+                    job.failed = True
+            try:
+                for job, _, _ in batch:
+                    job.pending -= 1
+                await self._settle(job for job, _, _ in batch)
+            finally:
+                for _ in batch:
+                    self.upsert_queue.task_done()
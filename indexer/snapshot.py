@@ -0,0 +1,54 @@
+import os
+import pickle
+import logging
+from enum import Enum
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE_NAME = "/indexer/storage/snapshot.pickle"
+
+# (mtime_ns, size, inode)
+FileStat = tuple[int, int, int]
+
+
+class FileChange(Enum):
+    new = 1
+    modified = 2
+
+
+class CrawlSnapshot:
+
+    def __init__(self, entries: dict[str, FileStat] | None = None, loaded: bool = False):
+        self.entries: dict[str, FileStat] = entries if entries is not None else {}
+        self.loaded = loaded
+
+    @staticmethod
+    def load(file_name: str = SNAPSHOT_FILE_NAME) -> "CrawlSnapshot":
+        try:
+            with open(file_name, "rb") as f:
+                entries = pickle.load(f)
+            logger.info(f"Loaded crawl snapshot with {len(entries)} files")
+            return CrawlSnapshot(entries, loaded=True)
+        except FileNotFoundError:
+            logger.info("No crawl snapshot found, full crawl required")
+        except Exception as e:
+            logger.error(f"Failed to load crawl snapshot {file_name}: {e}")
+        return CrawlSnapshot()
+
+    def save(self, file_name: str = SNAPSHOT_FILE_NAME) -> None:
+        tmp_file_name = f"{file_name}.tmp"
+        with open(tmp_file_name, "wb") as f:
+            pickle.dump(self.entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file_name, file_name)
+        logger.info(f"Saved crawl snapshot with {len(self.entries)} files")
+
+    def change(self, path: str, stat: FileStat) -> FileChange | None:
+        old_stat = self.entries.get(path)
+        if old_stat is None:
+            return FileChange.new
+        if old_stat != stat:
+            return FileChange.modified
+        return None
+
+    def deleted(self, current: dict[str, FileStat]) -> list[str]:
+        return [path for path in self.entries if path not in current]
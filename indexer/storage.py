@@ -1,4 +1,7 @@
+import os
 import logging
+from sqlalchemy import delete, inspect, text
+from sqlalchemy.dialects.sqlite import insert
 from sqlmodel import Field, Session, SQLModel, create_engine, select
 
 from singleton import Singleton
@@ -11,16 +14,24 @@ class IndexingStatus(Enum):
     new_file = 1
     need_reindexing = 2
     no_need_reindexing = 3
+    error = 4
 
 
 class MinimaDoc(SQLModel, table=True):
     fpath: str = Field(primary_key=True)
     last_updated_seconds: int | None = Field(default=None, index=True)
+    content_hash: str | None = Field(default=None, index=True)
+
+
+class CrawledPath(SQLModel, table=True):
+    crawl_id: str = Field(primary_key=True)
+    fpath: str = Field(primary_key=True)
 
 
 class MinimaDocUpdate(SQLModel):
     fpath: str | None = None
     last_updated_seconds: int | None = None
+    content_hash: str | None = None
 
 
 sqlite_file_name = "/indexer/storage/database.db"
@@ -29,22 +40,53 @@ sqlite_url = f"sqlite:///{sqlite_file_name}"
 connect_args = {"check_same_thread": False}
 engine = create_engine(sqlite_url, connect_args=connect_args)
 
+SQLITE_BATCH_SIZE = 500
+
+
+def _batched(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _under(dir_path: str):
+    # A case-sensitive range on the primary key, LIKE would ignore case and scan the table.
+    # Every path below "dir/" sorts before "dir" followed by the character after the separator.
+    prefix = os.path.join(dir_path, "")
+    return (MinimaDoc.fpath >= prefix) & (MinimaDoc.fpath < prefix[:-1] + chr(ord(os.sep) + 1))
+
 
 class MinimaStore(metaclass=Singleton):
 
     @staticmethod
     def create_db_and_tables():
         SQLModel.metadata.create_all(engine)
+        MinimaStore.migrate_content_hash()
+        # Paths of crawls interrupted by a restart are never purged against.
+        with Session(engine) as session:
+            session.execute(delete(CrawledPath))
+            session.commit()
+
+    @staticmethod
+    def migrate_content_hash():
+        columns = {column["name"] for column in inspect(engine).get_columns(MinimaDoc.__tablename__)}
+        if "content_hash" in columns:
+            return
+        logger.info("Adding content_hash column to the store")
+        with engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {MinimaDoc.__tablename__} ADD COLUMN content_hash VARCHAR"))
+            connection.execute(text(
+                f"CREATE INDEX IF NOT EXISTS ix_{MinimaDoc.__tablename__}_content_hash "
+                f"ON {MinimaDoc.__tablename__} (content_hash)"
+            ))
 
     @staticmethod
-    def delete_m_doc(fpath: str) -> None:
+    def delete_m_docs(fpaths: list[str]) -> None:
         with Session(engine) as session:
-            statement = select(MinimaDoc).where(MinimaDoc.fpath == fpath)
-            results = session.exec(statement)
-            doc = results.one()
-            session.delete(doc)
+            for batch in _batched(fpaths, SQLITE_BATCH_SIZE):
+                statement = delete(MinimaDoc).where(MinimaDoc.fpath.in_(batch))
+                session.execute(statement)
             session.commit()
-            print("doc deleted:", doc)
+            logger.debug(f"docs deleted: {len(fpaths)}")
 
     @staticmethod
     def select_m_doc(fpath: str) -> MinimaDoc:
@@ -56,50 +98,104 @@ class MinimaStore(metaclass=Singleton):
             return doc
 
     @staticmethod
-    def find_removed_files(existing_file_paths: set[str]):
-        removed_files: list[str] = []
+    def add_crawled_paths(crawl_id: str, fpaths: list[str]) -> None:
+        if not fpaths:
+            return
+        statement = insert(CrawledPath).on_conflict_do_nothing()
         with Session(engine) as session:
-            statement = select(MinimaDoc)
-            results = session.exec(statement)
-            logger.debug(f"find_removed_files count found {results}")
-            for doc in results:
-                logger.debug(f"find_removed_files file {doc.fpath} checking to remove")
-                if doc.fpath not in existing_file_paths:
-                    logger.debug(f"find_removed_files file {doc.fpath} does not exist anymore, removing")
-                    removed_files.append(doc.fpath)
-        for fpath in removed_files:
-            MinimaStore.delete_m_doc(fpath)
+            session.execute(statement, [{"crawl_id": crawl_id, "fpath": fpath} for fpath in fpaths])
+            session.commit()
+
+    @staticmethod
+    def find_removed_files(crawl_id: str) -> list[str]:
+        not_crawled = (
+            ~select(CrawledPath.fpath)
+            .where(CrawledPath.crawl_id == crawl_id)
+            .where(CrawledPath.fpath == MinimaDoc.fpath)
+            .exists()
+        )
+        # The rows are left to the caller, files indexed after the crawl walked past them also show up here.
+        with Session(engine) as session:
+            removed_files = list(session.exec(select(MinimaDoc.fpath).where(not_crawled)))
+            session.execute(delete(CrawledPath).where(CrawledPath.crawl_id == crawl_id))
+            session.commit()
+        logger.debug(f"find_removed_files found {len(removed_files)} removed files")
         return removed_files
 
     @staticmethod
-    def check_needs_indexing(fpath: str, last_updated_seconds: int) -> IndexingStatus:
-        indexing_status: IndexingStatus = IndexingStatus.no_need_reindexing
+    def find_paths_under(dir_paths: list[str]) -> list[str]:
+        with Session(engine) as session:
+            fpaths: list[str] = []
+            for dir_path in dir_paths:
+                fpaths.extend(session.exec(select(MinimaDoc.fpath).where(_under(dir_path))))
+            return fpaths
+
+    @staticmethod
+    def find_dirs_with_paths(dir_paths: list[str]) -> list[str]:
+        with Session(engine) as session:
+            return [
+                dir_path for dir_path in dir_paths
+                if session.exec(select(MinimaDoc.fpath).where(_under(dir_path)).limit(1)).first() is not None
+            ]
+
+    @staticmethod
+    def find_duplicates(fpath: str, content_hash: str) -> list[str]:
+        # Hashes are stored once a file is fully indexed, so these paths hold complete points.
+        with Session(engine) as session:
+            statement = (
+                select(MinimaDoc.fpath)
+                .where(MinimaDoc.content_hash == content_hash)
+                .where(MinimaDoc.fpath != fpath)
+            )
+            return list(session.exec(statement))
+
+    @staticmethod
+    def check_needs_indexing_batch(files: list[tuple[str, int]]) -> dict[str, tuple[IndexingStatus, str | None]]:
         try:
+            stored: dict[str, tuple[int | None, str | None]] = {}
             with Session(engine) as session:
-                statement = select(MinimaDoc).where(MinimaDoc.fpath == fpath)
-                results = session.exec(statement)
-                doc = results.first()
-                if doc is not None:
-                    logger.debug(
-                        f"file {fpath} new last updated={last_updated_seconds} old last updated: {doc.last_updated_seconds}"
+                for batch in _batched(files, SQLITE_BATCH_SIZE):
+                    statement = (
+                        select(MinimaDoc.fpath, MinimaDoc.last_updated_seconds, MinimaDoc.content_hash)
+                        .where(MinimaDoc.fpath.in_([fpath for fpath, _ in batch]))
                     )
-                    if doc.last_updated_seconds < last_updated_seconds:
-                        indexing_status = IndexingStatus.need_reindexing
-                        logger.debug(f"file {fpath} needs indexing, timestamp changed")
-                        doc_update = MinimaDocUpdate(fpath=fpath, last_updated_seconds=last_updated_seconds)
-                        doc_data = doc_update.model_dump(exclude_unset=True)
-                        doc.sqlmodel_update(doc_data)
-                        session.add(doc)
-                        session.commit()
-                    else:
-                        logger.debug(f"file {fpath} doesn't need indexing, timestamp same")
-                else:
-                    doc = MinimaDoc(fpath=fpath, last_updated_seconds=last_updated_seconds)
-                    session.add(doc)
-                    session.commit()
-                    logger.debug(f"file {fpath} needs indexing, new file")
-                    indexing_status = IndexingStatus.new_file
-            return indexing_status
+                    for fpath, last_updated_seconds, content_hash in session.exec(statement):
+                        stored[fpath] = (last_updated_seconds, content_hash)
         except Exception as e:
-            logger.error(f"error updating file in the store {e}, skipping indexing")
-            return IndexingStatus.no_need_reindexing
+            logger.error(f"error reading files from the store {e}, indexing retried on the next crawl")
+            return {fpath: (IndexingStatus.error, None) for fpath, _ in files}
+
+        statuses: dict[str, tuple[IndexingStatus, str | None]] = {}
+        for fpath, last_updated_seconds in files:
+            doc = stored.get(fpath)
+            if doc is None:
+                logger.debug(f"file {fpath} needs indexing, new file")
+                statuses[fpath] = (IndexingStatus.new_file, None)
+            # Restored content can carry an older mtime, any change needs the hash check.
+            # A cleared hash marks a file whose last indexing failed.
+            elif doc[0] is None or doc[0] != last_updated_seconds or doc[1] is None:
+                logger.debug(f"file {fpath} needs indexing check, timestamp changed")
+                statuses[fpath] = (IndexingStatus.need_reindexing, doc[1])
+            else:
+                logger.debug(f"file {fpath} doesn't need indexing, timestamp same")
+                statuses[fpath] = (IndexingStatus.no_need_reindexing, doc[1])
+        return statuses
+
+    @staticmethod
+    def update_docs(docs: list[tuple[str, int, str | None]]) -> None:
+        if not docs:
+            return
+        statement = insert(MinimaDoc)
+        statement = statement.on_conflict_do_update(
+            index_elements=[MinimaDoc.fpath],
+            set_={
+                "last_updated_seconds": statement.excluded.last_updated_seconds,
+                "content_hash": statement.excluded.content_hash,
+            }
+        )
+        with Session(engine) as session:
+            session.execute(statement, [
+                {"fpath": fpath, "last_updated_seconds": last_updated_seconds, "content_hash": content_hash}
+                for fpath, last_updated_seconds, content_hash in docs
+            ])
+            session.commit()
@@ -0,0 +1,137 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Callable
+from watchfiles import awatch, Change
+from crawler import is_supported, walk_files, in_excluded_dir
+from ignore import IgnoreMatcher, IGNORE_FILE_NAME
+from storage import MinimaStore
+from async_loop import CONTAINER_PATH, file_message, live_executor
+
+logger = logging.getLogger(__name__)
+
+WATCH_DEBOUNCE_MS = int(os.environ.get("WATCH_DEBOUNCE_MS", 1600))
+WATCH_STEP_MS = int(os.environ.get("WATCH_STEP_MS", 100))
+WATCH_FORCE_POLLING = os.environ.get("WATCH_FORCE_POLLING", "false").lower() in ("1", "true", "yes")
+WATCH_RESTART_SECONDS = float(os.environ.get("WATCH_RESTART_SECONDS", 5))
+WATCH_MAX_RESTART_SECONDS = float(os.environ.get("WATCH_MAX_RESTART_SECONDS", 300))
+
+
+def _watched_file(path: str) -> bool:
+    return is_supported(path) or os.path.basename(path) == IGNORE_FILE_NAME
+
+
+def _watched_path(change: Change, path: str) -> bool:
+    # Folders have no extension to filter on, and a deleted folder can't be told apart from
+    # a deleted file anymore, so those deletions are checked against the known folders.
+    return _watched_file(path) or change == Change.deleted or os.path.isdir(path)
+
+
+def _excluded_dir(path: str, matcher: IgnoreMatcher) -> bool:
+    return (in_excluded_dir(path, CONTAINER_PATH) or matcher.ignored(path, is_dir=True)
+            or matcher.too_deep(path))
+
+
+async def _enqueue_directory(async_queue, path: str, matcher: IgnoreMatcher, known_dirs: set[str]) -> None:
+    # A folder created or moved in is reported once, not file by file.
+    count = 0
+    known_dirs.add(path)
+    async for files in walk_files(path, matcher):
+        for file_path, stat in files:
+            known_dirs.add(os.path.dirname(file_path))
+            await async_queue.enqueue(file_message(file_path, mtime_ns=stat[0], size=stat[1]))
+            count += 1
+    logger.info(f"Folder enqueue from watcher: {path} with {count} files")
+
+
+async def watch_loop(async_queue, on_restart: Callable[[], None] | None = None):
+    # Watching can fail (e.g. the inotify watch limit on a large tree). Events are lost while it is
+    # down, so each restart is followed by a crawl, and a watcher that keeps failing falls back to
+    # crawls every WATCH_MAX_RESTART_SECONDS.
+    delay = WATCH_RESTART_SECONDS
+    while True:
+        started = time.monotonic()
+        try:
+            await _watch_changes(async_queue)
+            logger.error(f"Watcher for {CONTAINER_PATH} stopped")
+        except Exception as e:
+            logger.error(f"Watcher for {CONTAINER_PATH} failed: {e}")
+        if time.monotonic() - started > WATCH_MAX_RESTART_SECONDS:
+            delay = WATCH_RESTART_SECONDS
+        logger.info(f"Restarting watcher in {delay}s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, WATCH_MAX_RESTART_SECONDS)
+        if on_restart is not None:
+            on_restart()
+
+
+async def _watch_changes(async_queue):
+    logger.info(f"Starting watch loop with path: {CONTAINER_PATH}")
+    loop = asyncio.get_running_loop()
+    matcher = IgnoreMatcher(CONTAINER_PATH)
+    # Folders the watcher saw created, their files may not be in the store yet.
+    known_dirs: set[str] = set()
+    async for changes in awatch(
+        CONTAINER_PATH,
+        watch_filter=_watched_path,
+        debounce=WATCH_DEBOUNCE_MS,
+        step=WATCH_STEP_MS,
+        force_polling=WATCH_FORCE_POLLING,
+    ):
+        # A debounced batch can report the same path several times (editor save
+        # via rename, git checkout), so the final state on disk decides.
+        removed_file_paths: list[str] = []
+        deleted_paths: list[str] = []
+        paths = {path for _, path in changes}
+        added_paths = {path for change, path in changes if change == Change.added}
+        if any(os.path.basename(path) == IGNORE_FILE_NAME for path in paths):
+            # Files newly ignored or re-included are picked up by the next reconcile crawl.
+            matcher.invalidate()
+        for path in paths:
+            if not _watched_file(path):
+                if os.path.islink(path) or _excluded_dir(path, matcher):
+                    logger.debug(f"Ignoring change of excluded folder: {path}")
+                elif os.path.isdir(path):
+                    if path in added_paths:
+                        await _enqueue_directory(async_queue, path, matcher, known_dirs)
+                elif not os.path.lexists(path):
+                    deleted_paths.append(path)
+                continue
+            if not is_supported(path):
+                continue
+            if (matcher.ignored(path, is_dir=False) or matcher.too_deep(os.path.dirname(path))
+                    or in_excluded_dir(os.path.dirname(path), CONTAINER_PATH)):
+                logger.debug(f"Ignoring change of excluded file: {path}")
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                removed_file_paths.append(path)
+                continue
+            except OSError as e:
+                logger.error(f"Failed to stat file {path}: {e}")
+                continue
+            if matcher.too_large(stat.st_size):
+                logger.debug(f"Ignoring change of file over size limit: {path}")
+                continue
+            await async_queue.enqueue(file_message(path, mtime_ns=stat.st_mtime_ns, size=stat.st_size))
+            logger.info(f"File enqueue from watcher: {path}")
+        # Swap files, lock files and other unsupported deletions are neither known folders nor
+        # have stored files below them, so they don't become removals.
+        removed_dir_paths = [path for path in deleted_paths if path in known_dirs]
+        unknown_paths = [path for path in deleted_paths if path not in known_dirs]
+        if unknown_paths:
+            removed_dir_paths += await loop.run_in_executor(
+                live_executor, MinimaStore.find_dirs_with_paths, unknown_paths
+            )
+        for dir_path in removed_dir_paths:
+            prefix = os.path.join(dir_path, "")
+            known_dirs.difference_update([path for path in known_dirs if path == dir_path or path.startswith(prefix)])
+        if removed_file_paths or removed_dir_paths:
+            await async_queue.enqueue({
+                "removed_file_paths": removed_file_paths,
+                "removed_dir_paths": removed_dir_paths,
+                "type": "removed_files"
+            })
+            logger.info(f"Removed files from watcher: {removed_file_paths}, folders: {removed_dir_paths}")
@@ -1,49 +1,157 @@
-import requests
+import os
+import httpx
+import random
+import asyncio
+import msgpack
 import logging
+import time
+import numpy as np
 from typing import Any, List
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 from langchain_core.embeddings import Embeddings
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 REQUEST_DATA_URL = "http://indexer:8000/embedding"
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 64))
+# application/json, application/x-float32, application/x-float16 or application/msgpack
+EMBEDDING_WIRE_FORMAT = os.environ.get("EMBEDDING_WIRE_FORMAT", "application/x-float32")
 REQUEST_HEADERS = {
     'Accept': 'application/json',
     'Content-Type': 'application/json'
 }
+REQUEST_TIMEOUT = httpx.Timeout(
+    float(os.environ.get("EMBEDDING_REQUEST_TIMEOUT_SECONDS", 30)),
+    connect=float(os.environ.get("EMBEDDING_CONNECT_TIMEOUT_SECONDS", 5))
+)
+CONNECTION_LIMITS = httpx.Limits(max_connections=16, max_keepalive_connections=8, keepalive_expiry=60)
+REQUEST_ATTEMPTS = int(os.environ.get("EMBEDDING_REQUEST_ATTEMPTS", 3))
+RETRY_BACKOFF_SECONDS = float(os.environ.get("EMBEDDING_RETRY_BACKOFF_SECONDS", 0.2))
+BINARY_DTYPES = {
+    "application/x-float32": np.dtype("<f4"),
+    "application/x-float16": np.dtype("<f2"),
+}
+
+
+def decode_vectors(response: httpx.Response) -> np.ndarray:
+    media_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+    if media_type == "application/msgpack":
+        data = msgpack.unpackb(response.content)
+        return np.frombuffer(data["result"], dtype=np.dtype(data["dtype"])).reshape(data["shape"])
+    count = int(response.headers["X-Embedding-Count"])
+    dim = int(response.headers["X-Embedding-Dim"])
+    return np.frombuffer(response.content, dtype=BINARY_DTYPES[media_type]).reshape(count, dim)
+
+
+def retry_delay(attempt: int) -> float:
+    # Full jitter, so clients that failed together do not retry together.
+    return random.uniform(0, RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+
+def is_retryable(error: httpx.HTTPError) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
 
 class MinimaEmbeddings(BaseModel, Embeddings):
+    batch_size: int = EMBEDDING_BATCH_SIZE
+    wire_format: str = EMBEDDING_WIRE_FORMAT
+    _client: httpx.Client = PrivateAttr()
+    _async_client: httpx.AsyncClient = PrivateAttr()
 
     def __init__(self, **kwargs: Any):
         super().__init__(**kwargs)
+        headers = {**REQUEST_HEADERS, 'Accept': self.wire_format}
+        self._client = httpx.Client(headers=headers, timeout=REQUEST_TIMEOUT, limits=CONNECTION_LIMITS)
+        self._async_client = httpx.AsyncClient(headers=headers, timeout=REQUEST_TIMEOUT, limits=CONNECTION_LIMITS)
+
+    def _batches(self, texts: list[str]):
+        for i in range(0, len(texts), self.batch_size):
+            yield {"texts": texts[i:i + self.batch_size]}
+
+    @staticmethod
+    def _result(embedding: dict):
+        if "error" in embedding:
+            logger.error(f"Error in embedding: {embedding['error']}")
+            raise ValueError(embedding["error"])
+        return embedding["result"]
+
+    @staticmethod
+    def _collect(results: list, embeddings: dict, payload: dict) -> None:
+        # Callers zip texts with vectors, a short or failed batch must not shift them.
+        vectors = MinimaEmbeddings._result(embeddings)
+        if len(vectors) != len(payload["texts"]):
+            raise ValueError(f"Expected {len(payload['texts'])} embeddings, received {len(vectors)}")
+        results.extend(vectors)
 
     def embed_documents(self, texts: list[str]) -> list[list[float]]:
         results = []
-        for text in texts:
-            embedding = self.request_data(text)
-            if "error" in embedding:
-                logger.error(f"Error in embedding: {embedding['error']}")
-            else:
-                embedding = embedding["result"]
-                results.append(embedding)
+        for payload in self._batches(texts):
+            self._collect(results, self.request_data(payload), payload)
         return results
 
     def embed_query(self, text: str) -> list[float]:
-        return self.embed_documents([text])[0]
-
-    def request_data(self, query):
-        payload = {
-            "query": query
-        }
-        try:
-            logger.info(f"Requesting data from indexer with query: {query}")
-            response = requests.post(REQUEST_DATA_URL, headers=REQUEST_HEADERS, json=payload)
-            response.raise_for_status()
-            data = response.json()
-            logger.info(f"Received data: {data}")
-            return data
-
-        except requests.exceptions.RequestException as e:
-            logger.error(f"HTTP error: {e}")
-            return {"error": str(e)}
\ No newline at end of file
+        return self._result(self.request_data({"query": text}))
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        results = []
+        for payload in self._batches(texts):
+            self._collect(results, await self.arequest_data(payload), payload)
+        return results
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return self._result(await self.arequest_data({"query": text}))
+
+    @staticmethod
+    def _describe(payload: dict) -> str:
+        # Texts and vectors are only counted, logging them costs more than the request.
+        texts = payload["texts"] if "texts" in payload else [payload["query"]]
+        return f"{len(texts)} texts, {sum(len(text) for text in texts)} characters"
+
+    @staticmethod
+    def parse_response(response: httpx.Response, payload: dict) -> dict:
+        if not response.headers.get("Content-Type", "").startswith("application/json"):
+            vectors = decode_vectors(response)
+            logger.info(f"Received {vectors.shape[0]} embeddings")
+            # float32 rows are converted in one C-level pass, float16 ones widened first.
+            vectors = vectors.astype(np.float32, copy=False).tolist()
+            return {"result": vectors if "texts" in payload else vectors[0]}
+        data = response.json()
+        logger.info(f"Received JSON response of {len(response.content)} bytes")
+        return data
+
+    def request_data(self, payload: dict):
+        logger.info(f"Requesting embeddings from indexer: {self._describe(payload)}")
+        for attempt in range(REQUEST_ATTEMPTS):
+            try:
+                response = self._client.post(REQUEST_DATA_URL, json=payload)
+                response.raise_for_status()
+                return self.parse_response(response, payload)
+            except httpx.HTTPError as e:
+                if attempt + 1 == REQUEST_ATTEMPTS or not is_retryable(e):
+                    logger.error(f"HTTP error: {e}")
+                    return {"error": str(e)}
+                logger.warning(f"HTTP error, retrying: {e}")
+                time.sleep(retry_delay(attempt))
+
+    async def arequest_data(self, payload: dict):
+        logger.info(f"Requesting embeddings from indexer: {self._describe(payload)}")
+        for attempt in range(REQUEST_ATTEMPTS):
+            try:
+                response = await self._async_client.post(REQUEST_DATA_URL, json=payload)
+                response.raise_for_status()
+                return self.parse_response(response, payload)
+            except httpx.HTTPError as e:
+                if attempt + 1 == REQUEST_ATTEMPTS or not is_retryable(e):
+                    logger.error(f"HTTP error: {e}")
+                    return {"error": str(e)}
+                logger.warning(f"HTTP error, retrying: {e}")
+                await asyncio.sleep(retry_delay(attempt))
+
+    def close(self) -> None:
+        self._client.close()
+
+    async def aclose(self) -> None:
+        await self._async_client.aclose()